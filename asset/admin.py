@@ -1,5 +1,5 @@
 from django.contrib import admin
-from asset.models import AssetInfo, AssetLoginUser, AssetProject,AssetBusiness
+from asset.models import AssetInfo, AssetLoginUser, AssetProject,AssetBusiness, AssetImportLog
 from guardian.admin import GuardedModelAdmin
 
 
@@ -21,7 +21,13 @@ class AssetProjectAdmin(GuardedModelAdmin):
     pass
 
 
+class AssetImportLogAdmin(admin.ModelAdmin):
+    list_display = ('task_id', 'add_user', 'file', 'status', 'total', 'created', 'updated', 'failed', 'ctime')
+    list_filter = ('status', 'add_user')
+
+
 admin.site.register(AssetInfo, AssetAdmin)
 admin.site.register(AssetProject, AssetProjectAdmin)
 admin.site.register(AssetLoginUser, AssetUserAdmin)
-admin.site.register(AssetBusiness)
\ No newline at end of file
+admin.site.register(AssetBusiness)
+admin.site.register(AssetImportLog, AssetImportLogAdmin)
@@ -1,16 +1,172 @@
+import hashlib
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.utils.dateparse import parse_datetime
 from rest_framework import generics
+from rest_framework import permissions
+from rest_framework import status
+from rest_framework.exceptions import PermissionDenied, ValidationError
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+
+from .bulk import AssetUpsert, UPSERT_KEYS, bulk_delete
 from .models import AssetInfo
+from .permission import get_project_ids
+from .search import search_query
 from .serializers import AssetSerializer
-from rest_framework import permissions
+from .tree import get_tree_version
 
 
-class AssetList(generics.ListCreateAPIView):
-    queryset = AssetInfo.objects.all()
-    serializer_class = AssetSerializer
-    permission_classes = (permissions.AllowAny,)
+class AssetCursorPagination(CursorPagination):
+    """
+    游标分页,  翻页不受 新增/删除 影响,  深分页 也只是一次 id 范围查询
+    """
+    ordering = '-id'
+    page_size = getattr(settings, 'API_PAGE_SIZE', 100)
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
 
 
-class AssetDetail(generics.RetrieveUpdateDestroyAPIView):
-    queryset = AssetInfo.objects.all()
+class AssetQuerysetMixin:
+    """
+    只返回 调用者 有读取权限 的项目资产
+    支持 ?q= 查询  ?project= ?business= (名称)  ?project_id= ?business_id= (ID)
+    ?platform= ?region= ?is_active= ?updated_since=
+    """
+    filters = {
+        'project': 'project__projects', 'business': 'business__business',
+        'project_id': 'project_id', 'business_id': 'business_id', 'platform': 'platform', 'region': 'region',
+    }
     serializer_class = AssetSerializer
-    permission_classes = (permissions.AllowAny,)
+    permission_classes = (permissions.DjangoModelPermissions,)
+    queryset = AssetInfo.objects.all()
+
+    def get_queryset(self):
+        project_ids = get_project_ids(self.request.user, 'read_assetproject')
+        qs = AssetInfo.objects.filter(project_id__in=project_ids).select_related('project', 'business', 'user')
+        params = self.request.query_params
+        if params.get('q'):
+            qs = qs.filter(search_query(params.get('q')))
+        for name, field in self.filters.items():
+            if params.get(name):
+                qs = qs.filter(**{field: params.get(name)})
+        if params.get('is_active'):
+            qs = qs.filter(is_active=params.get('is_active') in ('1', 'true', 'True'))
+        try:
+            updated_since = parse_datetime(params.get('updated_since', ''))
+        except ValueError:
+            raise ValidationError({'updated_since': '时间格式错误'})
+        if updated_since:
+            qs = qs.filter(utime__gte=updated_since)
+        return qs
+
+    def check_project(self, project):
+        if project.id not in get_project_ids(self.request.user, 'change_assetproject'):
+            raise PermissionDenied('没有 资产项目 {0} 的权限'.format(project))
+
+
+class ETagMixin:
+    """
+    If-None-Match 与 ETag 相同时 返回 304,  轮询方不再重复下载 未变化的数据
+    """
+
+    def get_etag(self, request, *args, **kwargs):
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        etag = '"{0}"'.format(self.get_etag(request, *args, **kwargs))
+        if etag in [i.strip() for i in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = super().get(request, *args, **kwargs)
+        response['ETag'] = etag
+        return response
+
+
+class AssetList(ETagMixin, AssetQuerysetMixin, generics.ListCreateAPIView):
+    pagination_class = AssetCursorPagination
+
+    def get_etag(self, request, *args, **kwargs):
+        """
+        由 结果集的 数量 / 最大id / 最后更新时间, 资产树版本号(项目/业务 改名), 可读项目 和 查询参数 计算
+        """
+        stats = self.get_queryset().order_by().aggregate(count=Count('id'), max_id=Max('id'), utime=Max('utime'))
+        project_ids = sorted(get_project_ids(request.user, 'read_assetproject'))
+        key = '{0}-{1}-{2}-{3}-{4}-{5}'.format(stats['count'], stats['max_id'], stats['utime'], get_tree_version(),
+                                              project_ids, request.get_full_path())
+        return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    def perform_create(self, serializer):
+        self.check_project(serializer.validated_data['project'])
+        serializer.save()
+
+
+class AssetDetail(ETagMixin, AssetQuerysetMixin, generics.RetrieveUpdateDestroyAPIView):
+
+    def get_etag(self, request, *args, **kwargs):
+        obj = self.get_object()
+        key = '{0}-{1}-{2}-{3}'.format(obj.id, obj.utime, get_tree_version(), request.get_full_path())
+        return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    def perform_update(self, serializer):
+        self.check_project(serializer.instance.project)
+        if 'project' in serializer.validated_data:
+            self.check_project(serializer.validated_data['project'])
+        serializer.save()
+
+    def perform_destroy(self, instance):
+        if instance.project_id not in get_project_ids(self.request.user, 'delete_assetproject'):
+            raise PermissionDenied('没有 资产项目 {0} 的删除权限'.format(instance.project))
+        instance.delete()
+
+
+class AssetBulk(AssetQuerysetMixin, generics.GenericAPIView):
+    """
+    批量 新建/更新/删除 资产,  以 hostname 或 Instance_id 为键
+    POST   {"key": "hostname", "assets": [{"hostname": "", "project": "项目名或ID", ...}, ...]}
+    DELETE {"key": "hostname", "assets": ["hostname", ...]}
+    返回每一项的结果
+    """
+
+    def get_items(self, request):
+        data = request.data
+        key = data.get('key', 'hostname') if isinstance(data, dict) else request.query_params.get('key', 'hostname')
+        items = data.get('assets') if isinstance(data, dict) else data
+        if not isinstance(items, list):
+            raise ValidationError('assets 必须是列表')
+        if len(items) > getattr(settings, 'BULK_MAX_ITEMS', 5000):
+            raise ValidationError('每次最多 {0} 项'.format(getattr(settings, 'BULK_MAX_ITEMS', 5000)))
+        if key not in UPSERT_KEYS:
+            raise ValidationError('key 只能是 {0}'.format(' / '.join(UPSERT_KEYS)))
+        return key, items
+
+    def post(self, request, *args, **kwargs):
+        if not request.user.has_perm('asset.change_assetinfo'):
+            raise PermissionDenied()
+        key, items = self.get_items(request)
+        project_ids = get_project_ids(request.user, 'change_assetproject')
+        results = AssetUpsert(key, project_ids).run(items)
+        return Response({
+            'created': len([r for r in results if r['status'] == 201]),
+            'updated': len([r for r in results if r['status'] == 200]),
+            'failed': len([r for r in results if r['status'] >= 400]),
+            'results': results,
+        })
+
+    def delete(self, request, *args, **kwargs):
+        key, items = self.get_items(request)
+        rows = {}
+        for pk, value in AssetInfo.objects.filter(**{key + '__in': items}).values_list('id', key):
+            rows.setdefault(value, []).append(pk)
+        project_ids = get_project_ids(request.user, 'delete_assetproject')
+        outcomes = bulk_delete(AssetInfo, [pk for pks in rows.values() for pk in pks], project_ids)
+        results = []
+        for value in items:
+            statuses = [outcomes[pk] for pk in rows.get(value, [])] or ['not_found']
+            status_ = 'deleted' if set(statuses) == {'deleted'} else [s for s in statuses if s != 'deleted'][0]
+            results.append({'key': value, 'status': status_, 'id': rows.get(value)})
+        return Response({
+            'deleted': len([r for r in results if r['status'] == 'deleted']),
+            'results': results,
+        })
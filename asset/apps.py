@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+
+class AssetConfig(AppConfig):
+    name = 'asset'
+
+    def ready(self):
+        from asset import signals  # noqa
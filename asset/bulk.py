@@ -0,0 +1,297 @@
+from itertools import groupby
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Case, When, Value
+from django.utils import timezone
+
+from asset.models import AssetInfo, AssetProject, AssetBusiness, AssetLoginUser
+from asset.search import ip_to_num
+from asset.tree import clear_asset_tree
+
+__all__ = [
+    'bulk_update',
+    'save_batch',
+    'check_ids',
+    'bulk_delete',
+    'delete_error',
+    'AssetUpsert',
+]
+
+
+def bulk_update(model, objs, fields, batch_size=None):
+    """
+    Django 2.0 没有 QuerySet.bulk_update,   每批 用一条 UPDATE ... CASE WHEN 更新
+    :param objs:  带主键的 model 实例
+    :param fields:  需要更新的 字段名
+    """
+    fields = [model._meta.get_field(name) for name in fields]
+    batch_size = batch_size or len(objs) or 1
+    rows = 0
+    for i in range(0, len(objs), batch_size):
+        batch = objs[i:i + batch_size]
+        updates = {}
+        for field in fields:
+            whens = [When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field)) for obj in batch]
+            updates[field.attname] = Case(*whens, output_field=field)
+        rows += model.objects.filter(pk__in=[obj.pk for obj in batch]).update(**updates)
+    return rows
+
+
+def save_batch(model, creates, updates, batch_size=None):
+    """
+    一批 bulk_create + bulk_update,  批量写入失败时 逐行重试 找出失败的行
+    :param creates:  新建的实例
+    :param updates:  [(更新的字段, 实例)],  字段相同的 合并为一条 UPDATE
+    :return:  (创建成功的实例, 更新成功的实例, [(失败的实例, 错误)])
+    """
+    updates = sorted(updates, key=lambda u: u[0])
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create(creates, batch_size=batch_size)
+            for fields, batch in groupby(updates, key=lambda u: u[0]):
+                bulk_update(model, [obj for _, obj in batch], fields, batch_size=batch_size)
+        return creates, [obj for _, obj in updates], []
+    except Exception:
+        pass
+
+    created, updated, failed = [], [], []
+    for obj in creates:
+        try:
+            with transaction.atomic():
+                model.objects.bulk_create([obj])
+            created.append(obj)
+        except Exception as e:
+            failed.append((obj, e))
+    for fields, obj in updates:
+        try:
+            with transaction.atomic():
+                bulk_update(model, [obj], fields)
+            updated.append(obj)
+        except Exception as e:
+            failed.append((obj, e))
+    return created, updated, failed
+
+
+def check_ids(model, ids, project_ids, project_field='project_id'):
+    """
+    校验 id,  一次查询 取出所属项目,  与 可操作的项目 比对
+    :param ids:  请求中的 id 列表,  可以是字符串
+    :param project_ids:  有权限的 项目ID 集合
+    :return:  (有权限的 id 列表, {id: 状态})  状态 ok / invalid / not_found / forbidden
+    """
+    outcomes, valid = {}, []
+    for i in ids:
+        try:
+            valid.append(int(i))
+        except (TypeError, ValueError):
+            outcomes[i] = 'invalid'
+    valid = list(dict.fromkeys(valid))
+
+    owners = dict(model.objects.filter(id__in=valid).values_list('id', project_field))
+    allowed = []
+    for i in valid:
+        if i not in owners:
+            outcomes[i] = 'not_found'
+        elif owners[i] not in project_ids:
+            outcomes[i] = 'forbidden'
+        else:
+            outcomes[i] = 'ok'
+            allowed.append(i)
+    return allowed, outcomes
+
+
+def bulk_delete(model, ids, project_ids, chunk_size=None, project_field='project_id'):
+    """
+    批量删除,  权限校验后 在一个事务中 按 chunk_size 分块删除
+    :return:  {id: 状态}  状态 deleted / invalid / not_found / forbidden
+    """
+    chunk_size = chunk_size or getattr(settings, 'BULK_CHUNK_SIZE', 500)
+    allowed, outcomes = check_ids(model, ids, project_ids, project_field)
+    with transaction.atomic():
+        for i in range(0, len(allowed), chunk_size):
+            model.objects.filter(id__in=allowed[i:i + chunk_size]).delete()
+    outcomes.update((i, 'deleted') for i in allowed)
+    return outcomes
+
+
+DELETE_ERRORS = (
+    ('forbidden', '没有删除权限'),
+    ('not_found', '不存在'),
+    ('invalid', 'ID 无效'),
+)
+
+
+def delete_error(outcomes):
+    """
+    按 bulk_delete 的状态 分别说明 未删除的原因,  全部删除时 返回 None
+    :return:  例如 "没有删除权限: 3 5; 不存在: 7"
+    """
+    errors = []
+    for status, message in DELETE_ERRORS:
+        ids = [str(k) for k, v in outcomes.items() if v == status]
+        if ids:
+            errors.append('{0}: {1}'.format(message, ' '.join(ids)))
+    return '; '.join(errors) or None
+
+
+UPSERT_KEYS = ('hostname', 'Instance_id')
+UPSERT_SKIP_FIELDS = ('id', 'ctime', 'utime', 'network_ip_num', 'inner_ip_num', 'hardware_time')
+
+
+class AssetUpsert:
+    """
+    按 hostname 或 Instance_id 批量 新建/更新 资产
+    外键 project / business / user 可以是 id 或 名称,  每批 一次查询 取出已存在的资产 和 唯一字段占用,
+    权限 按项目ID 集合 判断,  不逐行查询
+    每一项的结果 {"index", "key", "status", "id", "error"}  status: 201 新建 200 更新 400 错误 403 无权限
+    """
+
+    def __init__(self, key, project_ids, batch_size=None):
+        if key not in UPSERT_KEYS:
+            raise ValueError('key 只能是 {0}'.format(' / '.join(UPSERT_KEYS)))
+        self.key = key
+        self.project_ids = project_ids
+        self.batch_size = batch_size or getattr(settings, 'BULK_CHUNK_SIZE', 500)
+        self.fields = {f.name: f for f in AssetInfo._meta.fields if f.name not in UPSERT_SKIP_FIELDS}
+        self.related = {
+            'project': self.related_map(AssetProject, 'projects'),
+            'business': self.related_map(AssetBusiness, 'business'),
+            'user': self.related_map(AssetLoginUser, 'hostname'),
+        }
+        self.seen, self.claimed = set(), {}
+        self.results = []
+
+    @staticmethod
+    def related_map(model, name_field):
+        rows = list(model.objects.values_list('id', name_field))
+        names = {name: pk for pk, name in rows}
+        names.update((pk, pk) for pk, _ in rows)
+        return names
+
+    def parse(self, item):
+        values = {}
+        for name, v in item.items():
+            field = self.fields.get(name)
+            if field is None:
+                raise ValueError('未知字段 {0}'.format(name))
+            if name in self.related:
+                if v in (None, ''):
+                    values[field.attname] = None
+                elif v in self.related[name]:
+                    values[field.attname] = self.related[name][v]
+                else:
+                    raise ValueError('{0} {1} 不存在'.format(field.verbose_name, v))
+            elif v in (None, '') and field.null:
+                values[name] = None
+            else:
+                try:
+                    values[name] = field.to_python(v)
+                except ValidationError as e:
+                    raise ValueError('{0} {1}'.format(field.verbose_name, '; '.join(e.messages)))
+        return values
+
+    def result(self, index, key, status, pk=None, error=None):
+        self.results.append({'index': index, 'key': key, 'status': status, 'id': pk, 'error': error})
+
+    def unique_owners(self, name, values):
+        values = [v for v in values if v]
+        if not values:
+            return {}
+        owners = dict(AssetInfo.objects.filter(**{name + '__in': values}).values_list(name, 'id'))
+        # 前面批次 已占用 但尚未写入的值
+        for (field, value), pk in self.claimed.items():
+            if field == name:
+                owners.setdefault(value, pk)
+        return owners
+
+    def run_batch(self, batch):
+        keys = [item.get(self.key) for _, item in batch if isinstance(item, dict)]
+        existing = {}
+        for row in AssetInfo.objects.filter(**{self.key + '__in': [k for k in keys if k]}).values('id', self.key, 'project_id'):
+            existing.setdefault(row[self.key], []).append(row)
+
+        parsed = []
+        for index, item in batch:
+            key = item.get(self.key) if isinstance(item, dict) else None
+            if not key:
+                self.result(index, key, 400, error='缺少 {0}'.format(self.key))
+                continue
+            if key in self.seen:
+                self.result(index, key, 400, error='{0} 在请求中重复'.format(self.key))
+                continue
+            self.seen.add(key)
+            if len(existing.get(key, [])) > 1:
+                self.result(index, key, 400, error='{0} 对应多个资产'.format(self.key))
+                continue
+            try:
+                values = self.parse(item)
+            except (ValueError, TypeError) as e:
+                self.result(index, key, 400, error=str(e))
+                continue
+            parsed.append((index, key, existing.get(key, [None])[0], values))
+
+        hostnames = self.unique_owners('hostname', [v.get('hostname') for _, _, _, v in parsed])
+        network_ips = self.unique_owners('network_ip', [v.get('network_ip') for _, _, _, v in parsed])
+
+        creates, updates, pending = [], [], {}
+        now = timezone.now()
+        for index, key, row, values in parsed:
+            pk = row['id'] if row else None
+            # 新建的行 没有主键,  用 各自的 token 占用 唯一值,  否则 同批 重复的值 None == None 会通过检查
+            owner = pk if row else object()
+            project_id = values.get('project_id', row['project_id'] if row else None)
+            if not row and not (values.get('hostname') and project_id):
+                self.result(index, key, 400, error='新建资产 主机名 和 资产项目 不能为空')
+                continue
+            if row and row['project_id'] not in self.project_ids or project_id not in self.project_ids:
+                self.result(index, key, 403, pk, error='没有 资产项目 的权限')
+                continue
+            if values.get('hostname') and hostnames.get(values['hostname'], owner) != owner:
+                self.result(index, key, 400, pk, error='主机名 {0} 已存在'.format(values['hostname']))
+                continue
+            if values.get('network_ip') and network_ips.get(values['network_ip'], owner) != owner:
+                self.result(index, key, 400, pk, error='内网IP {0} 已存在'.format(values['network_ip']))
+                continue
+            for name, owners in (('hostname', hostnames), ('network_ip', network_ips)):
+                if values.get(name):
+                    owners[values[name]] = owner
+                    self.claimed[(name, values[name])] = owner
+
+            if row:
+                for ip in ('network_ip', 'inner_ip'):
+                    if ip in values:
+                        values[ip + '_num'] = ip_to_num(values[ip])
+                values['utime'] = now
+                obj = AssetInfo(id=pk, **values)
+                updates.append((tuple(sorted(values)), obj))
+            else:
+                obj = AssetInfo(**values)
+                obj.set_ip_num()
+                creates.append(obj)
+            pending[id(obj)] = (index, key)
+
+        created, updated, failed = save_batch(AssetInfo, creates, updates, self.batch_size)
+        # MySQL 的 bulk_create 不返回主键,  按 hostname 查回
+        created_ids = dict(AssetInfo.objects.filter(
+            hostname__in=[obj.hostname for obj in created]).values_list('hostname', 'id')) if created else {}
+        for obj in created:
+            self.result(*pending[id(obj)], status=201, pk=created_ids.get(obj.hostname))
+        for obj in updated:
+            self.result(*pending[id(obj)], status=200, pk=obj.id)
+        for obj, e in failed:
+            self.result(*pending[id(obj)], status=400, pk=obj.id, error=str(e))
+
+    def run(self, items):
+        """
+        :param items:  [{字段: 值}, ...]
+        :return:  每一项的结果,  按请求顺序
+        """
+        items = list(enumerate(items))
+        with transaction.atomic():
+            for i in range(0, len(items), self.batch_size):
+                self.run_batch(items[i:i + self.batch_size])
+        if any(r['status'] in (200, 201) for r in self.results):
+            clear_asset_tree()
+        return sorted(self.results, key=lambda r: r['index'])
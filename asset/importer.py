@@ -0,0 +1,209 @@
+import csv
+import io
+
+import chardet
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+
+from asset.bulk import save_batch
+from asset.models import AssetInfo, AssetProject, AssetBusiness, AssetLoginUser
+from asset.search import ip_to_num
+from asset.tree import clear_asset_tree
+
+__all__ = [
+    'AssetImporter',
+    'detect_encoding',
+]
+
+
+def detect_encoding(f, size=64 * 1024):
+    """
+    只读取文件开头 检测编码,  检测完 文件指针 归零
+    """
+    head = f.read(size)
+    f.seek(0)
+    encoding = (chardet.detect(head)['encoding'] or 'utf-8').lower()
+    if encoding in ('ascii', 'utf-8'):
+        return 'utf-8-sig'
+    if encoding in ('gb2312', 'gbk'):
+        return 'gb18030'
+    return encoding
+
+
+class AssetImporter:
+    """
+    资产 CSV 批量导入
+    逐行读取 CSV,  外键 按预加载的 名称->ID 映射 解析,  每 batch_size 行 bulk_create / bulk_update 一次,
+    全部在一个事务中完成,   某一批写入失败时 该批逐行重试 定位失败的行
+    """
+    skip_fields = ['date_created', 'ctime', 'utime', 'network_ip_num', 'inner_ip_num', 'hardware_time']
+
+    def __init__(self, batch_size=None, progress=None):
+        """
+        :param batch_size:  每批写入的行数,  默认 settings.IMPORT_BATCH_SIZE
+        :param progress:  每批写入后 回调 progress(counts)
+        """
+        self.batch_size = batch_size or getattr(settings, 'IMPORT_BATCH_SIZE', 500)
+        self.progress = progress
+        self.fields = {
+            field.verbose_name: field for field in AssetInfo._meta.fields
+            if field.name not in self.skip_fields
+        }
+        self.created, self.updated, self.failed = [], [], []
+        self.total = 0
+
+    def load_maps(self):
+        self.projects = dict(AssetProject.objects.values_list('projects', 'id'))
+        self.business = dict(AssetBusiness.objects.values_list('business', 'id'))
+        self.users = dict(AssetLoginUser.objects.values_list('hostname', 'id'))
+        self.hostnames = dict(AssetInfo.objects.values_list('hostname', 'id'))
+        self.network_ips = dict(AssetInfo.objects.exclude(network_ip=None).values_list('network_ip', 'id'))
+
+    def parse_row(self, columns, row):
+        """
+        :return:  (id, {attname: value})
+        """
+        id_, values = None, {}
+        for field, v in zip(columns, row):
+            if field is None:
+                continue
+            v = v.strip()
+            if field.name == 'id':
+                id_ = int(v) if v.isdigit() else None
+            elif field.name == 'is_active':
+                values['is_active'] = v in ['TRUE', '1', 'true']
+            elif field.name == 'port':
+                values['port'] = int(v) if v.isdigit() else 22
+            elif field.name == 'project':
+                values['project_id'] = self.projects.get(v)
+            elif field.name == 'business':
+                values['business_id'] = self.business.get(v)
+            elif field.name == 'user':
+                values['user_id'] = self.users.get(v)
+            elif not v and field.null:
+                values[field.attname] = None
+            else:
+                try:
+                    values[field.attname] = field.to_python(v)
+                except ValidationError as e:
+                    raise ValueError('{0} {1}'.format(field.verbose_name, '; '.join(e.messages)))
+        return id_, values
+
+    def check_unique(self, owner, values):
+        """
+        :param owner:  更新时 为资产ID,  新建时 为该行的 token (新建的行 没有ID,  不能都用 None 占用)
+        """
+        hostname, network_ip = values.get('hostname'), values.get('network_ip')
+        if hostname and self.hostnames.get(hostname, owner) != owner:
+            raise ValueError('已经创建了，无法重复创建 此 hostname')
+        if network_ip and self.network_ips.get(network_ip, owner) != owner:
+            raise ValueError('内网IP {0} 已存在'.format(network_ip))
+
+    def flush(self, columns, rows):
+        parsed = []
+        for row in rows:
+            try:
+                parsed.append(self.parse_row(columns, row))
+            except ValueError as e:
+                hostname = [v for field, v in zip(columns, row) if field and field.name == 'hostname']
+                self.failed.append('%s: %s' % (''.join(hostname), str(e)))
+        ids = [id_ for id_, _ in parsed if id_]
+        existing = set(AssetInfo.objects.filter(id__in=ids).values_list('id', flat=True)) if ids else set()
+
+        creates, updates = [], []
+        for id_, values in parsed:
+            if id_ not in existing:
+                id_ = None
+                if not values.get('hostname'):
+                    self.failed.append('%s: %s' % ('', '主机名 不能为空'))
+                    continue
+                if not values.get('project_id'):
+                    self.failed.append('%s: %s' % (values['hostname'], '资产项目 不存在'))
+                    continue
+            else:
+                # 与原有逻辑一致,  只更新 有值的字段
+                values = {k: v for k, v in values.items() if v}
+            owner = id_ if id_ is not None else object()
+            try:
+                self.check_unique(owner, values)
+            except ValueError as e:
+                self.failed.append('%s: %s' % (values.get('hostname', id_), str(e)))
+                continue
+            if values.get('hostname'):
+                self.hostnames[values['hostname']] = owner
+            if values.get('network_ip'):
+                self.network_ips[values['network_ip']] = owner
+            if id_ is None:
+                obj = AssetInfo(**values)
+                obj.set_ip_num()
+                creates.append(obj)
+            else:
+                for ip in ('network_ip', 'inner_ip'):
+                    if ip in values:
+                        values[ip + '_num'] = ip_to_num(values[ip])
+                values['utime'] = timezone.now()
+                updates.append((tuple(sorted(values)), AssetInfo(id=id_, **values)))
+
+        self.save(creates, updates)
+        self.total += len(rows)
+        if self.progress:
+            self.progress(self.counts())
+
+    def save(self, creates, updates):
+        created, updated, failed = save_batch(AssetInfo, creates, updates, self.batch_size)
+        self.created.extend(obj.hostname for obj in created)
+        self.updated.extend(obj.hostname or str(obj.id) for obj in updated)
+        self.failed.extend('%s: %s' % (obj.hostname or obj.id, str(e)) for obj, e in failed)
+
+    def counts(self):
+        return {
+            'total': self.total,
+            'created': len(self.created),
+            'updated': len(self.updated),
+            'failed': len(self.failed),
+        }
+
+    def run(self, f):
+        """
+        :param f:  二进制文件对象,  例如 上传文件的 .file
+        :return:  导入结果
+        """
+        self.load_maps()
+        text = io.TextIOWrapper(f, encoding=detect_encoding(f), newline='')
+        try:
+            reader = csv.reader(text)
+            header = next(reader, [])
+            columns = [self.fields.get(name.strip().lstrip('\ufeff')) for name in header]
+            with transaction.atomic():
+                rows = []
+                for row in reader:
+                    if set(row) <= {''}:
+                        continue
+                    rows.append(row)
+                    if len(rows) >= self.batch_size:
+                        self.flush(columns, rows)
+                        rows = []
+                if rows:
+                    self.flush(columns, rows)
+        finally:
+            text.detach()
+
+        if self.created or self.updated:
+            clear_asset_tree()
+        return self.result()
+
+    def result(self):
+        created, updated, failed = self.created, self.updated, self.failed
+        return {
+            'created': created,
+            'created_info': 'Created {}'.format(len(created)),
+            'updated': updated,
+            'updated_info': 'Updated {}'.format(len(updated)),
+            'failed': failed,
+            'failed_info': 'Failed {}'.format(len(failed)),
+            'valid': True,
+            'msg': 'Created: {}. Updated: {}, Error: {}'.format(
+                len(created), len(updated), len(failed))
+        }
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from asset.bulk import bulk_update
+from asset.models import AssetInfo
+from asset.search import ip_to_num
+
+
+class Command(BaseCommand):
+    help = '重建 资产查询 的 IP 数值列 (network_ip_num / inner_ip_num)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        rows = AssetInfo.objects.order_by('id').values_list('id', 'network_ip', 'inner_ip')
+        objs, total = [], 0
+        for pk, network_ip, inner_ip in rows.iterator(chunk_size=batch_size):
+            objs.append(AssetInfo(id=pk, network_ip_num=ip_to_num(network_ip), inner_ip_num=ip_to_num(inner_ip)))
+            if len(objs) >= batch_size:
+                total += bulk_update(AssetInfo, objs, ('network_ip_num', 'inner_ip_num'))
+                objs = []
+        if objs:
+            total += bulk_update(AssetInfo, objs, ('network_ip_num', 'inner_ip_num'))
+        self.stdout.write('updated {0} assets'.format(total))
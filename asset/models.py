@@ -1,10 +1,14 @@
 from django.db import models
+from jsonfield import JSONField
 import random
 
+from asset.search import ip_to_num
+
 __all__ = [
     'AssetInfo',
     'AssetLoginUser',
-    'AssetProject'
+    'AssetProject',
+    'AssetImportLog'
 ]
 
 
@@ -100,6 +104,21 @@ class AssetInfo(models.Model):
     ctime = models.DateTimeField(auto_now_add=True, null=True, verbose_name='创建时间', blank=True)
     utime = models.DateTimeField(auto_now=True, null=True, verbose_name='更新时间', blank=True)
 
+    # IPv4 的整数形式,  用于 网段(CIDR) 范围查询,  由 set_ip_num 维护
+    network_ip_num = models.BigIntegerField(verbose_name='内网IP数值', null=True, blank=True, editable=False)
+    inner_ip_num = models.BigIntegerField(verbose_name='外网IP数值', null=True, blank=True, editable=False)
+
+    # 最近一次 硬件信息 检查时间,  由 tasks.tasks.HardwareWriter 维护,  与 utime 无关
+    hardware_time = models.DateTimeField(verbose_name='硬件同步时间', null=True, blank=True, editable=False)
+
+    def set_ip_num(self):
+        self.network_ip_num = ip_to_num(self.network_ip)
+        self.inner_ip_num = ip_to_num(self.inner_ip)
+
+    def save(self, *args, **kwargs):
+        self.set_ip_num()
+        super().save(*args, **kwargs)
+
     @property
     def users(self):
         users = AssetLoginUser.objects.get(hostname=self.user)
@@ -109,6 +128,46 @@ class AssetInfo(models.Model):
         db_table = "AssetInfo"
         verbose_name = "资产管理"
         verbose_name_plural = '资产管理'
+        indexes = [
+            models.Index(fields=['network_ip_num'], name='asset_network_ip_num_idx'),
+            models.Index(fields=['inner_ip_num'], name='asset_inner_ip_num_idx'),
+            models.Index(fields=['inner_ip'], name='asset_inner_ip_idx'),
+            models.Index(fields=['project', 'business'], name='asset_project_business_idx'),
+            models.Index(fields=['platform', 'region'], name='asset_platform_region_idx'),
+            models.Index(fields=['region'], name='asset_region_idx'),
+            models.Index(fields=['hardware_time'], name='asset_hardware_time_idx'),
+        ]
 
     def __str__(self):
         return self.hostname
+
+
+class AssetImportLog(models.Model):
+    STATUS_CHOICES = (
+        ("PENDING", "等待"),
+        ("STARTED", "导入中"),
+        ("SUCCESS", "完成"),
+        ("FAILURE", "失败"),
+    )
+
+    task_id = models.UUIDField(verbose_name='任务ID', unique=True)
+    add_user = models.CharField(max_length=255, verbose_name='创建者', null=True, blank=True)
+    file = models.FileField(upload_to='upload/import/%Y%m%d', verbose_name="导入文件")
+    status = models.CharField(max_length=24, choices=STATUS_CHOICES, default="PENDING", verbose_name='状态')
+
+    total = models.IntegerField(verbose_name='已处理行数', default=0)
+    created = models.IntegerField(verbose_name='创建', default=0)
+    updated = models.IntegerField(verbose_name='更新', default=0)
+    failed = models.IntegerField(verbose_name='失败', default=0)
+    summary = JSONField(null=True, blank=True, default=dict, verbose_name='导入结果')
+
+    ctime = models.DateTimeField(auto_now_add=True, null=True, verbose_name='创建时间', blank=True)
+    utime = models.DateTimeField(auto_now=True, null=True, verbose_name='更新时间', blank=True)
+
+    class Meta:
+        db_table = "AssetImportLog"
+        verbose_name = "资产导入"
+        verbose_name_plural = '资产导入'
+
+    def __str__(self):
+        return "{0}".format(self.task_id)
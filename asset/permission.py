@@ -0,0 +1,95 @@
+import time
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from guardian.models import GroupObjectPermission, UserObjectPermission
+
+from asset.models import AssetProject
+
+__all__ = [
+    'get_project_ids',
+    'has_project_perm',
+    'clear_user_perms',
+    'clear_all_perms',
+]
+
+PERMS_VERSION_KEY = 'asset-project-perms-version'
+
+
+def _cache_enabled():
+    """
+    LocMemCache 是 进程内缓存,  撤销权限时 其他进程(gunicorn / celery) 的缓存 不会失效,  此时 不缓存 权限
+    """
+    return not isinstance(caches['default'], LocMemCache)
+
+
+def _perms_key(user_id):
+    """
+    用户权限矩阵 缓存key,  带上全局版本号, 版本号自增 即全部失效
+    """
+    version = cache.get_or_set(PERMS_VERSION_KEY, 1, None)
+    return 'asset-project-perms-{0}-{1}'.format(version, user_id)
+
+
+def _resolve_project_ids(user, perm):
+    """
+    查询数据库  用户权限 和 用户所在组的权限 各一次查询,   超级用户 返回全部项目
+    """
+    if not user.is_active:
+        return set()
+    if user.is_superuser:
+        return set(AssetProject.objects.values_list('id', flat=True))
+
+    content_type = ContentType.objects.get_for_model(AssetProject)
+    user_perms = UserObjectPermission.objects.filter(
+        user=user, permission__codename=perm, content_type=content_type
+    ).values_list('object_pk', flat=True)
+    group_perms = GroupObjectPermission.objects.filter(
+        group__user=user, permission__codename=perm, content_type=content_type
+    ).values_list('object_pk', flat=True)
+
+    return {int(pk) for pk in user_perms} | {int(pk) for pk in group_perms}
+
+
+def get_project_ids(user, perm):
+    """
+    获取用户 对 资产项目 拥有 perm 权限 的 项目ID 集合
+    结果按用户缓存为 {codename: set(project_id)},  由 asset.signals 负责失效
+    :param user:  系统用户
+    :param perm:  权限 codename 例如 read_assetproject
+    :return:  set(project_id)
+    """
+    if not _cache_enabled():
+        return _resolve_project_ids(user, perm)
+    key = _perms_key(user.pk)
+    matrix = cache.get(key) or {}
+    if perm not in matrix:
+        matrix[perm] = _resolve_project_ids(user, perm)
+        cache.set(key, matrix, getattr(settings, 'PERMS_CACHE_TIMEOUT', 300))
+    return matrix[perm]
+
+
+def has_project_perm(user, perm, project_id):
+    """
+    判断用户 对 单个资产项目 是否有 perm 权限
+    """
+    return project_id in get_project_ids(user, perm)
+
+
+def clear_user_perms(user_ids):
+    """
+    清除指定用户的 权限矩阵 缓存
+    """
+    cache.delete_many([_perms_key(user_id) for user_id in user_ids])
+
+
+def clear_all_perms():
+    """
+    版本号自增,  所有用户的 权限矩阵 缓存失效
+    """
+    try:
+        cache.incr(PERMS_VERSION_KEY)
+    except ValueError:
+        cache.set(PERMS_VERSION_KEY, int(time.time()), None)
@@ -0,0 +1,95 @@
+import ipaddress
+
+from django.conf import settings
+from django.db.models import Q, Count
+
+__all__ = [
+    'ip_to_num',
+    'search_query',
+    'search_assets',
+    'filter_facets',
+    'facet_counts',
+]
+
+# 分面字段  url参数 -> 统计字段
+FACETS = (
+    ('project', 'project__projects'),
+    ('business', 'business__business'),
+    ('platform', 'platform'),
+    ('region', 'region'),
+)
+
+
+def ip_to_num(ip):
+    """
+    IPv4 转为整数,  用于 网段(CIDR) 范围查询,  其他返回 None
+    """
+    try:
+        ip = ipaddress.ip_address(ip.strip())
+    except (ValueError, AttributeError):
+        return None
+    return int(ip) if ip.version == 4 else None
+
+
+def search_query(query):
+    """
+    查询条件
+    10.0.0.0/16:  内网IP 或 外网IP 在网段内
+    10.0.0.1:  内网IP 或 外网IP 相等
+    其他:  主机名 / IP 前缀,  或 项目名称 相等
+    """
+    query = query.strip()
+    if '/' in query:
+        try:
+            network = ipaddress.ip_network(query, strict=False)
+        except ValueError:
+            network = None
+        if network is not None and network.version == 4:
+            ip_range = (int(network.network_address), int(network.broadcast_address))
+            return Q(network_ip_num__range=ip_range) | Q(inner_ip_num__range=ip_range)
+
+    if ip_to_num(query) is not None:
+        return Q(network_ip=query) | Q(inner_ip=query)
+
+    return Q(hostname__istartswith=query) | Q(network_ip__startswith=query) | \
+        Q(inner_ip__startswith=query) | Q(project__projects=query)
+
+
+def search_assets(qs, query, limit=None):
+    """
+    联想查询,   先走索引的 前缀匹配,   不足 limit 条时 再用 主机名 包含 补齐
+    :return:  [{id, hostname, network_ip, inner_ip}]
+    """
+    limit = limit or getattr(settings, 'SEARCH_LIMIT', 20)
+    fields = ('id', 'hostname', 'network_ip', 'inner_ip')
+    rows = list(qs.filter(search_query(query)).order_by('hostname').values(*fields)[:limit])
+    if len(rows) < limit and len(query) >= 3 and '/' not in query:
+        ids = [i['id'] for i in rows]
+        rows.extend(qs.filter(hostname__icontains=query).exclude(id__in=ids).order_by('hostname')
+                    .values(*fields)[:limit - len(rows)])
+    return rows
+
+
+def filter_facets(qs, params):
+    """
+    按 平台 / 区域 / 业务 过滤,  项目 由资产树的 project 参数处理
+    """
+    if params.get('business') and not params.get('project'):
+        qs = qs.filter(business__business=params.get('business'))
+    if params.get('platform'):
+        qs = qs.filter(platform=params.get('platform'))
+    if params.get('region'):
+        qs = qs.filter(region=params.get('region'))
+    return qs
+
+
+def facet_counts(qs):
+    """
+    当前结果的 分面统计
+    :return:  {"project": [(名称, 数量), ...], ...}
+    """
+    counts = {}
+    for name, field in FACETS:
+        rows = qs.order_by().values_list(field).annotate(count=Count('id')).order_by('-count')
+        counts[name] = [(value, count) for value, count in rows if value]
+    return counts
@@ -2,7 +2,26 @@ from rest_framework import serializers
 from .models import AssetInfo
 
 
-class AssetSerializer(serializers.ModelSerializer):
+class DynamicFieldsMixin:
+    """
+    ?fields=hostname,network_ip  只返回指定的字段
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        fields = request.query_params.get('fields') if request is not None else None
+        if fields:
+            allowed = set(fields.split(','))
+            for name in set(self.fields) - allowed:
+                self.fields.pop(name)
+
+
+class AssetSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    project_name = serializers.CharField(source='project.projects', read_only=True)
+    business_name = serializers.CharField(source='business.business', read_only=True, default=None)
+    user_name = serializers.CharField(source='user.hostname', read_only=True, default=None)
+
     class Meta:
         model = AssetInfo
         fields = '__all__'
@@ -0,0 +1,93 @@
+from django.contrib.auth.models import Group
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+from guardian.models import GroupObjectPermission, UserObjectPermission
+
+from asset.models import AssetInfo, AssetProject, AssetBusiness, AssetLoginUser
+from asset.permission import clear_user_perms, clear_all_perms
+from asset.tree import clear_asset_tree
+from name.models import Names
+
+
+def _is_project_perm(instance):
+    return instance.content_type_id == ContentType.objects.get_for_model(AssetProject).id
+
+
+@receiver(post_save, sender=GroupObjectPermission)
+@receiver(post_delete, sender=GroupObjectPermission)
+def group_object_perm_changed(sender, instance, **kwargs):
+    """
+    组对象权限 变更,  清除组内用户的 权限缓存
+    """
+    if _is_project_perm(instance):
+        clear_user_perms(Names.objects.filter(groups=instance.group_id).values_list('id', flat=True))
+
+
+@receiver(post_save, sender=UserObjectPermission)
+@receiver(post_delete, sender=UserObjectPermission)
+def user_object_perm_changed(sender, instance, **kwargs):
+    """
+    用户对象权限 变更,  清除该用户的 权限缓存
+    """
+    if _is_project_perm(instance):
+        clear_user_perms([instance.user_id])
+
+
+@receiver(m2m_changed, sender=Names.groups.through)
+def names_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    用户 加入/移出 组,  清除相关用户的 权限缓存
+    """
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        clear_user_perms([instance.pk])
+    elif pk_set:
+        clear_user_perms(pk_set)
+    else:
+        clear_user_perms(instance.user_set.values_list('id', flat=True))
+
+
+@receiver(pre_delete, sender=Group)
+def group_deleted(sender, instance, **kwargs):
+    """
+    组删除前 组成员关系还在,  清除组内用户的 权限缓存
+    """
+    clear_user_perms(instance.user_set.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Names)
+def names_saved(sender, instance, created, **kwargs):
+    """
+    用户 超级用户/激活 状态可能变更
+    """
+    update_fields = kwargs.get('update_fields')
+    if created or (update_fields and set(update_fields) == {'last_login'}):
+        return
+    clear_user_perms([instance.pk])
+
+
+@receiver(post_save, sender=AssetProject)
+@receiver(post_delete, sender=AssetProject)
+def asset_project_changed(sender, instance, **kwargs):
+    """
+    资产项目 增加/删除,  超级用户的项目集合 和 已删除项目的权限 都需要失效
+    """
+    if kwargs.get('created', True):
+        clear_all_perms()
+
+
+@receiver(post_save, sender=AssetInfo)
+@receiver(post_delete, sender=AssetInfo)
+@receiver(post_save, sender=AssetProject)
+@receiver(post_delete, sender=AssetProject)
+@receiver(post_save, sender=AssetBusiness)
+@receiver(post_delete, sender=AssetBusiness)
+@receiver(post_save, sender=AssetLoginUser)
+@receiver(post_delete, sender=AssetLoginUser)
+def asset_tree_changed(sender, **kwargs):
+    """
+    资产/项目/业务/登录用户 增删改,  资产树缓存 和 API 的 ETag (含 项目/业务/用户 名称) 失效
+    """
+    clear_asset_tree()
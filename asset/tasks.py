@@ -0,0 +1,60 @@
+import logging
+
+from celery import shared_task
+
+from asset.importer import AssetImporter
+from asset.models import AssetImportLog
+from tasks.ansible_2420.sink import ChannelSink
+
+logger = logging.getLogger('asset')
+
+# 导入结果中 最多保存的 失败明细 条数
+MAX_FAILED_DETAIL = 1000
+
+
+def remove_upload(file):
+    try:
+        file.storage.delete(file.name)
+    except OSError as e:
+        logger.error("删除导入文件失败 {0} {1}".format(file.name, e))
+
+
+@shared_task(bind=True)
+def asset_import(self, log_id):
+    """
+    后台 批量导入资产,  每批写入后 进度 推送到 上传用户的 channels 组
+    status 4: 导入进度  {status, job, total, created, updated, failed}
+    status 5: 导入结束  {status, job, total, created, updated, failed, error}
+    导入结束后 删除上传的文件,  导入记录 保留文件名
+    :param log_id:  AssetImportLog id
+    :return:  导入结果 统计
+    """
+    log = AssetImportLog.objects.get(id=log_id)
+    channel = ChannelSink(log.add_user, self.request.id)
+    AssetImportLog.objects.filter(id=log_id).update(status="STARTED")
+
+    def progress(counts):
+        channel.send(dict(counts, status=4, job=self.request.id))
+
+    importer = AssetImporter(progress=progress)
+    error = None
+    try:
+        with log.file.open('rb') as f:
+            data = importer.run(f.file)
+        summary = {k: v for k, v in data.items() if k not in ('created', 'updated')}
+        summary['failed'] = data['failed'][:MAX_FAILED_DETAIL]
+    except Exception as e:
+        logger.error("资产导入失败 {0} {1}".format(log.file.name, e))
+        error = "{}".format(e)
+        summary = {'error': error}
+    finally:
+        remove_upload(log.file)
+
+    counts = importer.counts()
+    if error:
+        # 事务已回滚,  没有资产被写入
+        counts.update(created=0, updated=0)
+    AssetImportLog.objects.filter(id=log_id).update(
+        status="FAILURE" if error else "SUCCESS", summary=summary, **counts)
+    channel.send(dict(counts, status=5, job=self.request.id, error=error))
+    return counts
@@ -0,0 +1,76 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+
+from asset.models import AssetInfo, AssetProject
+from asset.permission import get_project_ids
+
+__all__ = [
+    'get_asset_tree',
+    'get_tree_version',
+    'clear_asset_tree',
+]
+
+TREE_VERSION_KEY = 'asset-ztree-version'
+
+
+def get_tree_version():
+    """
+    资产/项目/业务 的变更版本号,  任何一项变更 都会自增
+    """
+    return cache.get_or_set(TREE_VERSION_KEY, 1, None)
+
+
+def _tree_key(user_id):
+    return 'asset-ztree-{0}-{1}'.format(get_tree_version(), user_id)
+
+
+def build_asset_tree(project_ids):
+    """
+    一次分组统计 生成 项目/业务 资产树
+    """
+    projects = AssetProject.objects.filter(id__in=project_ids).order_by('id').values_list('id', 'projects')
+    rows = AssetInfo.objects.filter(project_id__in=project_ids).values(
+        'project', 'business', 'business__business').annotate(count=Count('id')).order_by('business')
+
+    totals, business = {}, {}
+    for row in rows:
+        totals[row['project']] = totals.get(row['project'], 0) + row['count']
+        if row['business'] is not None:
+            business.setdefault(row['project'], []).append((row['business__business'], row['count']))
+
+    data = [{"id": "0", "pId": "0", "name": "项目"}, ]
+    for project_id, name in projects:
+        data.append({"id": "000{0}".format(project_id), "n": name, "pId": "0",
+                     "name": "{0}({1})".format(name, totals.get(project_id, 0)),
+                     "page": "xx.action"}, )
+        for b, count in business.get(project_id, []):
+            data.append({"id": b, "pId": "000{0}".format(project_id), "name": "{0}({1})".format(b, count),
+                         "page": "xx.action"}, )
+    return data
+
+
+def get_asset_tree(user):
+    """
+    获取用户可读的 资产树,  按用户缓存,  可读项目变化时 重新生成
+    """
+    project_ids = get_project_ids(user, 'read_assetproject')
+    key = _tree_key(user.pk)
+    cached = cache.get(key)
+    if cached and cached[0] == project_ids:
+        return cached[1]
+    data = build_asset_tree(project_ids)
+    cache.set(key, (project_ids, data), getattr(settings, 'ASSET_TREE_CACHE_TIMEOUT', 600))
+    return data
+
+
+def clear_asset_tree():
+    """
+    资产/项目/业务 变更后,  所有用户的 资产树缓存 失效
+    """
+    try:
+        cache.incr(TREE_VERSION_KEY)
+    except ValueError:
+        cache.set(TREE_VERSION_KEY, int(time.time()), None)
@@ -12,9 +12,11 @@ urlpatterns = [
     path('asset-export.html', views.AssetExport.as_view(), name='asset_export'),
     path('asset-import.html', views.AssetImport, name='asset_import'),
     path('asset-ztree.html', views.AssetZtree, name='asset_ztree'),
+    path('asset-search.html', views.AssetSearch, name='asset_search'),
 
     path('api/asset.html', api.AssetList.as_view(), name='asset_api_list'),
     path('api/asset-detail-<int:pk>.html', api.AssetDetail.as_view(), name='asset_api_detail'),
+    path('api/asset-bulk.html', api.AssetBulk.as_view(), name='asset_api_bulk'),
 
     path('asset-user.html', views.AssetUserListAll.as_view(), name='asset_user_list'),
     path('asset-user-add.html', views.AssetUserAdd.as_view(), name='asset_user_add'),
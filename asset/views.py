@@ -1,30 +1,32 @@
-import chardet
 import codecs
 import csv
 import json
-import time
 import logging
-from io import StringIO
+import uuid
 from os import system
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.db import transaction
 from django.db.models import Q
+from django.http import StreamingHttpResponse
 from django.shortcuts import render, HttpResponse
 from django.urls import reverse_lazy
 from django.utils.decorators import method_decorator
 from django.views.generic import ListView, View, CreateView, UpdateView, DetailView
 from guardian.decorators import permission_required_or_404
 
-from asset.models import AssetInfo, AssetLoginUser, AssetProject, AssetBusiness
+from asset.models import AssetInfo, AssetLoginUser, AssetProject, AssetBusiness, AssetImportLog
 from asset.models import AssetInfo as Asset
+from asset.bulk import bulk_delete, delete_error
+from asset.permission import get_project_ids, has_project_perm
+from asset.search import search_query, search_assets, filter_facets, facet_counts
+from asset.tasks import asset_import
+from asset.tree import get_asset_tree
 from chain import settings
-from index.password_crypt import encrypt_p, decrypt_p
-from name.models import Names
+from index.password_crypt import encrypt_p
 from tasks.models import Variable
-from tasks.tasks import ansbile_asset_hardware
+from tasks.tasks import ansbile_asset_hardware, asset_host
 from .form import AssetForm, FileForm, AssetUserForm, AssetProjectForm, AssetBusinessForm
 
 logger = logging.getLogger('asset')
@@ -56,6 +58,7 @@ class AssetListAll(LoginRequiredMixin, ListView):
             "asset_active": "active",
             "asset_list_active": "active",
             "asset_list":asset_list,
+            "facets": facet_counts(self.queryset),
             "web_ssh": getattr(settings, 'web_ssh'),
             "web_port": getattr(settings, 'web_port'),
         }
@@ -68,33 +71,38 @@ class AssetListAll(LoginRequiredMixin, ListView):
         """
         资产信息 查询功能
         """
-        name = Names.objects.get(username=self.request.user)
-        self.queryset = super().get_queryset()
-        excluded_assets = []
-        for i in self.queryset:
-            projects = AssetInfo.objects.get(hostname=i).project
-            project_obj = AssetProject.objects.get(projects=projects)
-            hasperm = name.has_perm('read_assetproject', project_obj)
-            if not hasperm:
-                excluded_assets.append(i)
-        self.queryset = self.queryset.exclude(hostname__in=excluded_assets)
+        project_ids = get_project_ids(self.request.user, 'read_assetproject')
+        self.queryset = super().get_queryset().filter(project_id__in=project_ids)
         if self.request.GET.get('name'):
             query = self.request.GET.get('name', None)
-            self.queryset = self.queryset.filter(
-                Q(network_ip=query) | Q(hostname=query) | Q(inner_ip=query) | Q(project__projects=query)).order_by(
-                '-id')
+            self.queryset = self.queryset.filter(search_query(query)).order_by('-id')
         elif self.request.GET.get('project'):
             project = self.request.GET.get('project', None)
             business = self.request.GET.get('business', None)
             if business is not None:
-                pro = AssetProject.objects.get(id=int(project)).projects
-                self.queryset = self.queryset.filter(Q(project__projects=pro), Q(business__business=business)).order_by(
+                self.queryset = self.queryset.filter(Q(project_id=int(project)), Q(business__business=business)).order_by(
                     '-id')
             else:
                 self.queryset = self.queryset.filter(Q(project__projects=project)).order_by('-id')
+        self.queryset = filter_facets(self.queryset, self.request.GET)
         return self.queryset
 
 
+@login_required
+def AssetSearch(request):
+    """
+    资产 联想查询  主机名/IP 前缀,  网段 例如 10.0.0.0/16
+    :param request:
+    :return:
+    """
+    query = request.GET.get('q', '').strip()
+    data = []
+    if query:
+        project_ids = get_project_ids(request.user, 'read_assetproject')
+        data = search_assets(AssetInfo.objects.filter(project_id__in=project_ids), query)
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+
 class AssetAdd(LoginRequiredMixin, CreateView):
     """
     资产信息 增加
@@ -138,10 +146,8 @@ class AssetUpdate(LoginRequiredMixin, UpdateView):
 
     def dispatch(self, *args, **kwargs):
         pk = self.kwargs.get(self.pk_url_kwarg, None)
-        name = Names.objects.get(username=self.request.user)
-        project = AssetInfo.objects.get(id=pk).project
-        project_obj = AssetProject.objects.get(projects=project)
-        hasperm = name.has_perm('change_assetproject', project_obj)
+        project_id = AssetInfo.objects.values_list('project_id', flat=True).get(id=pk)
+        hasperm = has_project_perm(self.request.user, 'change_assetproject', project_id)
         if not hasperm:
             return HttpResponse(status=500)
         return super().dispatch(*args, **kwargs)
@@ -176,10 +182,8 @@ class AssetDetail(LoginRequiredMixin, DetailView):
 
     def dispatch(self, *args, **kwargs):
         pk = self.kwargs.get(self.pk_url_kwarg, None)
-        name = Names.objects.get(username=self.request.user)
-        project = AssetInfo.objects.get(id=pk).project
-        project_obj = AssetProject.objects.get(projects=project)
-        hasperm = name.has_perm('read_assetproject', project_obj)
+        project_id = AssetInfo.objects.values_list('project_id', flat=True).get(id=pk)
+        hasperm = has_project_perm(self.request.user, 'read_assetproject', project_id)
         if not hasperm:
             return HttpResponse(status=500)
         return super().dispatch(*args, **kwargs)
@@ -208,32 +212,15 @@ class AssetAllDel(LoginRequiredMixin, View):
     @staticmethod
     def post(request):
         ret = {'status': True, 'error': None, }
-        name = Names.objects.get(username=request.user)
         try:
-            if request.POST.get('nid'):
-                ids = request.POST.get('nid', None)
-                project = AssetInfo.objects.get(id=ids).project
-                project_obj = AssetProject.objects.get(projects=project)
-                hasperm = name.has_perm('delete_assetproject', project_obj)
-                if not hasperm:
-                    ret['status'] = False
-                    ret['error'] = "没有删除权限"
-                    return HttpResponse(json.dumps(ret))
-                else:
-                    AssetInfo.objects.get(id=ids).delete()
-            else:
-                ids = request.POST.getlist('id', None)
-                idstring = ','.join(ids)
-                assets = AssetInfo.objects.extra(where=['id IN (' + idstring + ')'])
-                for i in assets:
-                    project = AssetInfo.objects.get(hostname=i).project
-                    project_obj = AssetProject.objects.get(projects=project)
-                    hasperm = name.has_perm('delete_assetproject', project_obj)
-                    if not hasperm:
-                        ret['status'] = False
-                        ret['error'] = "没有删除权限{0}".format(i)
-                    else:
-                        AssetInfo.objects.get(hostname=i).delete()
+            ids = [request.POST.get('nid')] if request.POST.get('nid') else request.POST.getlist('id', None)
+            project_ids = get_project_ids(request.user, 'delete_assetproject')
+            outcomes = bulk_delete(AssetInfo, ids, project_ids)
+            error = delete_error(outcomes)
+            if error:
+                ret['status'] = False
+                ret['error'] = error
+            ret['results'] = {str(k): v for k, v in outcomes.items()}
         except Exception as e:
             ret['status'] = False
             ret['error'] = '删除请求错误,没有权限{}'.format(e)
@@ -243,7 +230,8 @@ class AssetAllDel(LoginRequiredMixin, View):
 
 class AssetHardwareUpdate(LoginRequiredMixin, View):
     """
-    资产硬件    异步更新
+    资产硬件    异步批量更新
+    nid: 单个资产,  id: 多个资产,  project / business: 按项目 / 业务 选择资产
     """
     model = AssetInfo
 
@@ -251,24 +239,34 @@ class AssetHardwareUpdate(LoginRequiredMixin, View):
     def post(request):
         ret = {'status': True, 'error': None, }
         try:
+            project_ids = get_project_ids(request.user, 'read_assetproject')
+            qs = AssetInfo.objects.filter(project_id__in=project_ids).select_related('user')
             if request.POST.get('nid'):
-                ids = request.POST.get('nid', None)
-                asset_obj = AssetInfo.objects.get(id=ids)
-                try:
-                    asset_obj.user.hostname
-                except Exception as e:
-                    logger.error(e)
-                    ret['status'] = False
-                    ret['error'] = '未关联用户，请关联后再更新'.format(e)
-                    return HttpResponse(json.dumps(ret))
-                assets = [{"hostname": asset_obj.hostname,
-                           "ip": asset_obj.network_ip,
-                           "port": asset_obj.port,
-                           "username": asset_obj.user.username,
-                           "password": decrypt_p(asset_obj.user.password),
-                           "private_key": asset_obj.user.private_key.name
-                           }]
-                ansbile_asset_hardware.delay(ids, assets)
+                qs = qs.filter(id=request.POST.get('nid'))
+            elif request.POST.getlist('id'):
+                qs = qs.filter(id__in=request.POST.getlist('id'))
+            elif request.POST.get('project'):
+                qs = qs.filter(project_id=request.POST.get('project'))
+            elif request.POST.get('business'):
+                qs = qs.filter(business_id=request.POST.get('business'))
+            else:
+                qs = qs.none()
+
+            assets, no_user = [], []
+            for asset_obj in qs:
+                if asset_obj.user is None:
+                    no_user.append(asset_obj.hostname)
+                    continue
+                assets.append(asset_host(asset_obj))
+
+            if no_user:
+                ret['status'] = bool(assets)
+                ret['error'] = '未关联用户，请关联后再更新 {}'.format(' '.join(no_user))
+            elif not assets:
+                ret['status'] = False
+                ret['error'] = '没有可以更新的资产'
+            if assets:
+                ansbile_asset_hardware.delay(assets)
         except Exception as e:
             logger.error(e)
             ret['status'] = False
@@ -277,84 +275,61 @@ class AssetHardwareUpdate(LoginRequiredMixin, View):
             return HttpResponse(json.dumps(ret))
 
 
+class Echo:
+    """
+    csv.writer 的 伪文件对象,  write 直接返回 行内容 交给 StreamingHttpResponse
+    """
+
+    def write(self, value):
+        return value
+
+
+def stream_assets_csv(qs, filename='assets.csv'):
+    """
+    以 StreamingHttpResponse 流式导出 资产,  按 id 键集分页 每次查询 chunk_size 行,  内存占用与 资产数量 无关
+    (MySQL 驱动 会在客户端 缓存整个结果集,  QuerySet.iterator() 不能 分块读取)
+    """
+    fields = [
+        field for field in Asset._meta.fields
+        if field.name not in [
+            'date_created', 'network_ip_num', 'inner_ip_num', 'hardware_time'
+        ]
+    ]
+    writer = csv.writer(Echo(), dialect='excel', quoting=csv.QUOTE_MINIMAL)
+    chunk_size = getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+
+    def rows():
+        yield codecs.BOM_UTF8.decode('utf-8')
+        yield writer.writerow([field.verbose_name for field in fields])
+        assets = qs.select_related('project', 'business', 'user').order_by('id')
+        last_id = 0
+        while True:
+            chunk = list(assets.filter(id__gt=last_id)[:chunk_size])
+            for asset_ in chunk:
+                yield writer.writerow([getattr(asset_, field.name) for field in fields])
+            if len(chunk) < chunk_size:
+                break
+            last_id = chunk[-1].id
+
+    response = StreamingHttpResponse(rows(), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
+
+
 class AssetExport(View):
     """
     资产 导出  导出全部
     """
 
     def get(self, request):
-        # qs = asset.objects.all()
-        # return render_to_csv_response(qs)
-
-        fields = [
-            field for field in Asset._meta.fields
-            if field.name not in [
-                'date_created'
-            ]
-        ]
-        filename = 'assets.csv'
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
-        response.write(codecs.BOM_UTF8)
-        writer = csv.writer(
-            response,
-            dialect='excel',
-            quoting=csv.QUOTE_MINIMAL)
-
-        header = [field.verbose_name for field in fields]
-        writer.writerow(header)
-
-        name = Names.objects.get(username=request.user)
-        assets = []
-        for i in AssetInfo.objects.all():
-            project = AssetInfo.objects.get(hostname=i).project
-            project_obj = AssetProject.objects.get(projects=project)
-            hasperm = name.has_perm('read_assetproject', project_obj)
-            if hasperm:
-                assets.append(i)
-
-        for asset_ in assets:
-            data = [getattr(asset_, field.name) for field in fields]
-            writer.writerow(data)
-
-        return response
+        project_ids = get_project_ids(request.user, 'read_assetproject')
+        return stream_assets_csv(AssetInfo.objects.filter(project_id__in=project_ids))
 
     @staticmethod
     def post(request):
-        name = Names.objects.get(username=request.user)
         ids = request.POST.getlist('id', None)
-        idstring = []
-        for i in ids:
-            project = AssetInfo.objects.get(id=i).project
-            project_obj = AssetProject.objects.get(projects=project)
-            hasperm = name.has_perm('read_assetproject', project_obj)
-            if hasperm:
-                idstring.append(i)
-        idstring2 = ','.join(idstring)
-        qs = AssetInfo.objects.extra(where=['id IN (' + idstring2 + ')']).all()
-        # return  render_to_csv_response(qs)
-        fields = [
-            field for field in Asset._meta.fields
-            if field.name not in [
-                'date_created'
-            ]
-        ]
-        filename = 'assets.csv'
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
-        response.write(codecs.BOM_UTF8)
-
-        writer = csv.writer(
-            response,
-            dialect='excel',
-            quoting=csv.QUOTE_MINIMAL)
-
-        header = [field.verbose_name for field in fields]
-        writer.writerow(header)
-        for asset_ in qs:
-            data = [getattr(asset_, field.name) for field in fields]
-            writer.writerow(data)
-        return response
+        project_ids = get_project_ids(request.user, 'read_assetproject')
+        return stream_assets_csv(AssetInfo.objects.filter(id__in=ids, project_id__in=project_ids))
 
 
 def get_object_or_none(model, **kwargs):
@@ -368,108 +343,26 @@ def get_object_or_none(model, **kwargs):
 @login_required
 def AssetImport(request):
     """
-    资产 导入
+    资产 导入,  上传的文件 交给 celery 后台导入,  进度通过 websocket 推送
     :param request:
     :return:
     """
     form = FileForm()
+    msg, import_job = None, None
 
     if request.method == "POST":
         form = FileForm(request.POST, request.FILES)
         if form.is_valid():
-            f = form.cleaned_data['file']
-            det_result = chardet.detect(f.read())
-            f.seek(0)  # reset file seek index
-            file_data = f.read().decode(det_result['encoding']).strip(codecs.BOM_UTF8.decode())
-            csv_file = StringIO(file_data)
-            reader = csv.reader(csv_file)
-            csv_data = [row for row in reader]
-            fields = [
-                field for field in Asset._meta.fields
-                if field.name not in [
-                    'date_created'
-                ]
-            ]
-            header_ = csv_data[0]
-            mapping_reverse = {field.verbose_name: field.name for field in fields}
-            attr = [mapping_reverse.get(n, None) for n in header_]
-
-            created, updated, failed = [], [], []
-            assets = []
-            for row in csv_data[1:]:
-                if set(row) == {''}:
-                    continue
-
-                asset_dict = dict(zip(attr, row))
-                id_ = asset_dict.pop('id', 0)
-                for k, v in asset_dict.items():
-                    v = v.strip()
-                    if k == 'is_active':
-                        v = True if v in ['TRUE', 1, 'true'] else False
-                    elif k in ['port', ]:
-                        try:
-                            v = int(v)
-                        except ValueError:
-                            v = 22
-                    elif k in ['project']:
-                        try:
-                            v = AssetProject.objects.get(projects=v)
-                        except Exception as e:
-                            v = None
-                    elif k in ['business']:
-                        try:
-                            v = AssetBusiness.objects.get(business=v)
-                        except Exception as e:
-                            v = None
-                    elif k in ['user', ]:
-                        try:
-                            v = AssetLoginUser.objects.get(user=v)
-                        except Exception as e:
-                            v = None
-                    elif k in ['ctime', 'utime' ]:
-                        v = time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(time.time()))
-                    asset_dict[k] = v
-
-                asset = get_object_or_none(Asset, id=id_) if id_ else None
-                if not asset:
-                    try:
-                        if len(Asset.objects.filter(hostname=asset_dict.get('hostname'))):
-                            raise Exception('已经创建了，无法重复创建 此 hostname')
-                        with transaction.atomic():
-                            asset = Asset.objects.create(**asset_dict)
-                            created.append(asset_dict['hostname'])
-                            assets.append(asset)
-                    except Exception as e:
-                        failed.append('%s: %s' % (asset_dict['hostname'], str(e)))
-                else:
-                    for k, v in asset_dict.items():
-                        if v:
-                            setattr(asset, k, v)
-                    try:
-                        asset.save()
-                        updated.append(asset_dict['hostname'])
-                    except Exception as e:
-                        failed.append('%s: %s' % (asset_dict['hostname'], str(e)))
-
-            data = {
-                'created': created,
-                'created_info': 'Created {}'.format(len(created)),
-                'updated': updated,
-                'updated_info': 'Updated {}'.format(len(updated)),
-                'failed': failed,
-                'failed_info': 'Failed {}'.format(len(failed)),
-                'valid': True,
-                'msg': 'Created: {}. Updated: {}, Error: {}'.format(
-                    len(created), len(updated), len(failed))
-            }
-
-            return render(request, 'asset/asset-import.html', {'form': form,
-                                                               "asset_active": "active",
-                                                               "asset_list_active": "active",
-                                                               "msg": data})
+            log = AssetImportLog.objects.create(task_id=uuid.uuid4(), add_user=request.user.username,
+                                                file=form.cleaned_data['file'])
+            asset_import.apply_async((log.id,), task_id=str(log.task_id))
+            import_job = str(log.task_id)
+            msg = {'job': import_job, 'msg': '导入任务已提交, 后台导入中'}
 
+    logs = AssetImportLog.objects.filter(add_user=request.user.username).order_by('-id')[:10]
     return render(request, 'asset/asset-import.html',
-                  {'form': form, "asset_active": "active", "asset_list_active": "active", })
+                  {'form': form, "asset_active": "active", "asset_list_active": "active",
+                   "msg": msg, "import_job": import_job, "logs": logs})
 
 
 @login_required
@@ -479,28 +372,7 @@ def AssetZtree(request):
     :param request:
     :return:
     """
-    business = AssetBusiness.objects.all()
-    managers = AssetProject.objects.values("projects").distinct()
-    name = Names.objects.get(username=request.user)
-    manager = []
-    for i in managers:
-        project_obj = AssetProject.objects.get(projects=i['projects'])
-        hasperm = name.has_perm('read_assetproject', project_obj)
-        if hasperm:
-            manager.append(i)
-
-    data = [{"id": "0", "pId": "0", "name": "项目"}, ]
-    for i in manager:
-        project_id = AssetProject.objects.get(projects=i['projects']).id
-        data.append({"id": "000{0}".format(project_id), "n": i['projects'], "pId": "0",
-                     "name": "{0}({1})".format(i['projects'],
-                                               AssetInfo.objects.filter(project__projects=i['projects']).count()),
-                     "page": "xx.action"}, )
-        for b in business:
-            count = AssetInfo.objects.filter(project__projects=i['projects']).filter( business__business=b.business).count()
-            if count == 0:
-                continue
-            data.append({"id": b.business, "pId": "000{0}".format(project_id), "name": "{0}({1})".format(b.business,count), "page": "xx.action"}, )
+    data = get_asset_tree(request.user)
     return HttpResponse(json.dumps(data), content_type='application/json')
 
 
@@ -512,14 +384,8 @@ class AssetUserListAll(LoginRequiredMixin, ListView):
     model = AssetLoginUser
 
     def get_context_data(self, **kwargs):
-        name = Names.objects.get(username=self.request.user)
-        assets_user = []
-        for i in AssetLoginUser.objects.all():
-            project = AssetLoginUser.objects.get(hostname=i).project
-            project_obj = AssetProject.objects.get(projects=project)
-            hasperm = name.has_perm('read_assetproject', project_obj)
-            if hasperm:
-                assets_user.append(i)
+        project_ids = get_project_ids(self.request.user, 'read_assetproject')
+        assets_user = AssetLoginUser.objects.filter(project_id__in=project_ids)
         context = {
             "asset_active": "active",
             "asset_user_list": assets_user,
@@ -580,10 +446,8 @@ class AssetUserUpdate(LoginRequiredMixin, UpdateView):
 
     def dispatch(self, *args, **kwargs):
         pk = self.kwargs.get(self.pk_url_kwarg, None)
-        name = Names.objects.get(username=self.request.user)
-        project = AssetLoginUser.objects.get(id=pk).project
-        project_obj = AssetProject.objects.get(projects=project)
-        hasperm = name.has_perm('change_assetproject', project_obj)
+        project_id = AssetLoginUser.objects.values_list('project_id', flat=True).get(id=pk)
+        hasperm = has_project_perm(self.request.user, 'change_assetproject', project_id)
         if not hasperm:
             return HttpResponse(status=500)
         return super().dispatch(*args, **kwargs)
@@ -628,10 +492,8 @@ class AssetUserDetail(LoginRequiredMixin, DetailView):
 
     def dispatch(self, *args, **kwargs):
         pk = self.kwargs.get(self.pk_url_kwarg, None)
-        name = Names.objects.get(username=self.request.user)
-        pro = AssetLoginUser.objects.get(id=pk).project
-        proj = AssetProject.objects.get(projects=pro)
-        hasperm = name.has_perm('read_assetproject', proj)
+        project_id = AssetLoginUser.objects.values_list('project_id', flat=True).get(id=pk)
+        hasperm = has_project_perm(self.request.user, 'read_assetproject', project_id)
         if not hasperm:
             return HttpResponse(status=500)
         return super().dispatch(*args, **kwargs)
@@ -669,32 +531,15 @@ class AssetUserAllDel(LoginRequiredMixin, View):
     @staticmethod
     def post(request):
         ret = {'status': True, 'error': None, }
-        name = Names.objects.get(username=request.user)
         try:
-            if request.POST.get('nid'):
-                ids = request.POST.get('nid', None)
-                project = AssetLoginUser.objects.get(id=ids).project
-                project_obj = AssetProject.objects.get(projects=project)
-                hasperm = name.has_perm('delete_assetproject', project_obj)
-                if not hasperm:
-                    ret['status'] = False
-                    ret['error'] = "没有删除权限"
-                    return HttpResponse(json.dumps(ret))
-                else:
-                    AssetLoginUser.objects.get(id=ids).delete()
-            else:
-                ids = request.POST.getlist('id', None)
-                idstring = ','.join(ids)
-                assets = AssetLoginUser.objects.extra(where=['id IN (' + idstring + ')'])
-                for i in assets:
-                    pro = AssetLoginUser.objects.get(hostname=i).project
-                    proj = AssetProject.objects.get(projects=pro)
-                    rets = name.has_perm('delete_assetproject', proj)
-                    if not rets:
-                        ret['status'] = False
-                        ret['error'] = "没有删除权限{0}".format(i)
-                    else:
-                        AssetLoginUser.objects.get(hostname=i).delete()
+            ids = [request.POST.get('nid')] if request.POST.get('nid') else request.POST.getlist('id', None)
+            project_ids = get_project_ids(request.user, 'delete_assetproject')
+            outcomes = bulk_delete(AssetLoginUser, ids, project_ids)
+            error = delete_error(outcomes)
+            if error:
+                ret['status'] = False
+                ret['error'] = error
+            ret['results'] = {str(k): v for k, v in outcomes.items()}
         except Exception as e:
             ret['status'] = False
             ret['error'] = '删除请求错误,没有权限{}'.format(e)
@@ -713,11 +558,7 @@ class AssetWeb(LoginRequiredMixin, View):
         try:
             ids = request.POST.get('id', None)
             obj = AssetInfo.objects.get(id=ids)
-
-            name = Names.objects.get(username=request.user)
-            project = AssetInfo.objects.get(id=ids).project
-            project_obj = AssetProject.objects.get(projects=project)
-            hasperm = name.has_perm('cmd_assetproject', project_obj)
+            hasperm = has_project_perm(request.user, 'cmd_assetproject', obj.project_id)
             if not hasperm:
                 ret['status'] = False
                 ret['error'] = '请求错误,没有权限登录'
@@ -753,14 +594,8 @@ class AssetProjectListAll(LoginRequiredMixin, ListView):
     model = AssetProject
 
     def get_context_data(self, **kwargs):
-
-        name = Names.objects.get(username=self.request.user)
-        assets_project = []
-        for i in AssetProject.objects.all():
-            project_obj = AssetProject.objects.get(projects=i)
-            hasperm = name.has_perm('read_assetproject', project_obj)
-            if hasperm:
-                assets_project.append(i)
+        project_ids = get_project_ids(self.request.user, 'read_assetproject')
+        assets_project = AssetProject.objects.filter(id__in=project_ids)
 
         context = {
             "asset_active": "active",
@@ -802,12 +637,10 @@ class AssetProjectAllDel(LoginRequiredMixin, View):
     @staticmethod
     def post(request):
         ret = {'status': True, 'error': None, }
-        name = Names.objects.get(username=request.user)
         try:
             if request.POST.get('nid'):
                 ids = request.POST.get('nid', None)
-                project_obj = AssetProject.objects.get(id=ids).projects
-                hasperm = name.has_perm('delete_assetproject', project_obj)
+                hasperm = has_project_perm(request.user, 'delete_assetproject', int(ids))
                 if not hasperm:
                     ret['status'] = False
                     ret['error'] = "没有删除权限"
@@ -816,16 +649,14 @@ class AssetProjectAllDel(LoginRequiredMixin, View):
                     AssetProject.objects.get(id=ids).delete()
             else:
                 ids = request.POST.getlist('id', None)
-                idstring = ','.join(ids)
-                assets = AssetInfo.objects.extra(where=['id IN (' + idstring + ')'])
-                for i in assets:
-                    pro = AssetProject.objects.get(id=ids).projects
-                    rets = name.has_perm('delete_assetproject', pro)
+                projects = AssetProject.objects.filter(id__in=ids)
+                for i in projects:
+                    rets = has_project_perm(request.user, 'delete_assetproject', i.id)
                     if not rets:
                         ret['status'] = False
                         ret['error'] = "没有删除权限{0}".format(i)
                     else:
-                        AssetProject.objects.get(hostname=i).delete()
+                        i.delete()
 
         except Exception as e:
             ret['status'] = False
@@ -846,9 +677,7 @@ class AssetProjectUpdate(LoginRequiredMixin, UpdateView):
 
     def dispatch(self, *args, **kwargs):
         pk = self.kwargs.get(self.pk_url_kwarg, None)
-        name = Names.objects.get(username=self.request.user)
-        project_obj = AssetProject.objects.get(id=pk)
-        hasperm = name.has_perm('change_assetproject', project_obj)
+        hasperm = has_project_perm(self.request.user, 'change_assetproject', int(pk))
         if not hasperm:
             return HttpResponse(status=500)
         return super().dispatch(*args, **kwargs)
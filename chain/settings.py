@@ -161,6 +161,17 @@ STATICFILES_DIRS = (
     os.path.join(BASE_DIR, 'static'),
 )
 
+# 缓存 须为 多进程共享 的后端,  权限 / 资产树 的失效 依赖 所有进程 看到同一个版本号
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        },
+    },
+}
+
 # django-channels配置
 CHANNEL_LAYERS = {
     "default": {
@@ -203,6 +214,32 @@ PAGINATION_SETTINGS = {
 #每页 显示的 个数
 DISPLAY_PER_PAGE = 25
 
+# 用户 资产项目权限 缓存时间(秒),  权限变更时由 asset.signals 主动失效
+PERMS_CACHE_TIMEOUT = 300
+
+# 资产树 缓存时间(秒),  资产/项目/业务 变更时由 asset.signals 主动失效
+ASSET_TREE_CACHE_TIMEOUT = 600
+
+# 资产导出 每次从数据库读取的行数
+EXPORT_CHUNK_SIZE = 2000
+
+# 资产导入 每批 bulk_create / bulk_update 的行数
+IMPORT_BATCH_SIZE = 500
+
+# 资产 联想查询 返回的条数
+SEARCH_LIMIT = 20
+
+# REST 资产接口 默认每页条数,  可用 ?page_size= 调整 (最大 1000)
+API_PAGE_SIZE = 100
+
+# 批量操作 每批写入/删除的行数,  REST 批量接口 每次请求 最多的资产数
+BULK_CHUNK_SIZE = 500
+BULK_MAX_ITEMS = 5000
+
+# 工具脚本 按内容 sha1 缓存的目录 和 目录大小上限,  超出按最近使用时间清理
+SCRIPT_STORE_DIR = os.path.join(BASE_DIR, 'data', 'script')
+SCRIPT_STORE_MAX_SIZE = 64 * 1024 * 1024
+
 
 
 
@@ -244,6 +281,28 @@ LOGGING = {
 CELERY_RESULT_BACKEND = 'django-db'
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERYBEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+# ansible forks 按主机数 / CPU / 可用内存 自动计算,  限定在 MIN ~ MAX 之间
+ANSIBLE_FORKS_MIN = 5
+ANSIBLE_FORKS_MAX = 100
+ANSIBLE_FORKS_PER_CPU = 10
+# 每个 fork 预估占用内存(MB)
+ANSIBLE_FORK_MEMORY_MB = 64
+# ssh 连接超时(秒),  AdHocRunner/PlayBookRunner 可按次覆盖
+ANSIBLE_TIMEOUT = 60
+# 不可达主机数 达到该值时 提前终止执行,  None 不限制
+ANSIBLE_MAX_UNREACHABLE = None
+# ssh ControlMaster 连接复用,  空闲多少秒后关闭,  None 不复用
+# ansible.cfg 的 ssh_args 中 设置了 ControlPersist 时 以 ssh_args 为准 (ansible 默认 60s)
+ANSIBLE_SSH_CONTROL_PERSIST = 300
+# 每个 worker 最多保持的 ssh 主连接数
+ANSIBLE_SSH_CONTROL_MAX = 200
+# 工具执行 每个分片的主机数,  超过时按分片分发到多个 worker 并行执行
+TOOLS_SHARD_SIZE = 50
+# 硬件信息 增量同步 tasks.tasks.ansbile_hardware_sync:  MAX_AGE 秒内 已检查过硬件的资产跳过,
+# 每个分片 SHARD_SIZE 台,  一个分片 完成后 间隔 INTERVAL 秒 排队下一个
+HARDWARE_SYNC_MAX_AGE = 24 * 3600
+HARDWARE_SYNC_SHARD_SIZE = 50
+HARDWARE_SYNC_INTERVAL = 60
 # jet
 JET_DEFAULT_THEME = 'default'
 
@@ -7,8 +7,8 @@ from django_celery_beat.models import  CrontabSchedule, PeriodicTask, IntervalSc
 from django_celery_results.models import TaskResult
 from chain import settings
 import json, datetime, logging
-from asset.models import AssetInfo, AssetProject
-from name.models import Names
+from asset.models import AssetInfo
+from asset.permission import get_project_ids
 logger = logging.getLogger('crontab')
 from pure_pagination import PageNotAnInteger, Paginator
 
@@ -213,16 +213,13 @@ class PeriodicTasksAdd(LoginRequiredMixin, CreateView):
         return super().get_context_data(**kwargs)
 
     def form_valid(self, form):
-        name = Names.objects.get(username=self.request.user)
         forms = form.save(commit=False)
         if form.cleaned_data['task'] == 'tasks.tasks.ansbile_tools_crontab':
             asset = form.cleaned_data['args']
             asset_list = asset.strip('[]').replace('"', '').split(',')
-            for i in asset_list[1:]:
-                project = AssetInfo.objects.get(hostname=i).project
-                project_obj = AssetProject.objects.get(projects=project)
-                hasperm = name.has_perm('cmd_assetproject', project_obj)
-                if not hasperm:
+            project_ids = get_project_ids(self.request.user, 'cmd_assetproject')
+            for i in AssetInfo.objects.filter(hostname__in=asset_list[1:]):
+                if i.project_id not in project_ids:
                     forms.args = ["此主机没有权限,禁止执行"]
                     forms.enabled = False
         forms.save()
@@ -248,16 +245,13 @@ class PeriodicTasksUpdate(LoginRequiredMixin, UpdateView):
         return super().get_context_data(**kwargs)
 
     def form_valid(self, form):
-        name = Names.objects.get(username=self.request.user)
         forms = form.save(commit=False)
         if form.cleaned_data['task'] == 'tasks.tasks.ansbile_tools_crontab':
             asset = form.cleaned_data['args']
             asset_list = asset.strip('[]').replace('"', '').split(',')
-            for i in asset_list[1:]:
-                project = AssetInfo.objects.get(hostname=i).project
-                project_obj = AssetProject.objects.get(projects=project)
-                hasperm = name.has_perm('cmd_assetproject', project_obj)
-                if not hasperm:
+            project_ids = get_project_ids(self.request.user, 'cmd_assetproject')
+            for i in AssetInfo.objects.filter(hostname__in=asset_list[1:]):
+                if i.project_id not in project_ids:
                     forms.args = ["此主机没有权限,禁止执行"]
                     forms.enabled = False
         forms.save()
@@ -4,7 +4,26 @@ from ansible.plugins.callback import CallbackBase
 from ansible.plugins.callback.default import CallbackModule
 
 
-class AdHocResultCallback(CallbackModule):
+class UnreachableLimitMixin:
+    """
+    Terminate the task queue once max_unreachable hosts are unreachable
+    """
+    tqm = None
+    max_unreachable = None
+    unreachable_count = 0
+
+    def set_unreachable_limit(self, tqm, max_unreachable):
+        self.tqm = tqm
+        self.max_unreachable = max_unreachable
+
+    def v2_runner_on_unreachable(self, result, **kwargs):
+        self.unreachable_count += 1
+        if self.tqm and self.max_unreachable and self.unreachable_count >= self.max_unreachable:
+            self.tqm._terminated = True
+        super().v2_runner_on_unreachable(result, **kwargs)
+
+
+class AdHocResultCallback(UnreachableLimitMixin, CallbackModule):
     """
     Task result Callback
     """
@@ -67,6 +86,47 @@ class AdHocResultCallback(CallbackModule):
         super().v2_runner_on_unreachable(result)
 
 
+class StreamResultCallback(UnreachableLimitMixin, CallbackModule):
+    """
+    Streaming result callback, nothing is kept in memory:
+    every v2_runner_on_* event is trimmed and sent straight to the sink
+    """
+    trim_fields = ('stdout', 'stderr', 'rc', 'msg')
+
+    def __init__(self, sink, display=None, options=None):
+        self.sink = sink
+        super().__init__()
+
+    def gather_result(self, t, res):
+        task_result = res._result
+        event = {k: task_result.get(k) for k in self.trim_fields}
+        event.update(status=t, hostname=res._host.get_name(), task=res.task_name)
+        self.sink.emit(event)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self.gather_result("failed", result)
+        super().v2_runner_on_failed(result, ignore_errors=ignore_errors)
+
+    def v2_runner_on_ok(self, result):
+        self.gather_result("ok", result)
+        super().v2_runner_on_ok(result)
+
+    def v2_runner_on_skipped(self, result):
+        self.gather_result("skipped", result)
+        super().v2_runner_on_skipped(result)
+
+    def v2_runner_on_unreachable(self, result):
+        self.gather_result("unreachable", result)
+        super().v2_runner_on_unreachable(result)
+
+
+class FactsResultCallback(StreamResultCallback):
+    """
+    Streaming callback for setup tasks, ansible_facts is kept in the event
+    """
+    trim_fields = StreamResultCallback.trim_fields + ('ansible_facts',)
+
+
 class CommandResultCallback(AdHocResultCallback):
     """
     Command result callback
@@ -102,7 +162,7 @@ class CommandResultCallback(AdHocResultCallback):
         self.results_command[host] = cmd
 
 
-class PlaybookResultCallBack(CallbackBase):
+class PlaybookResultCallBack(UnreachableLimitMixin, CallbackBase):
     """
     Custom callback model for handlering the output data of
     execute playbook file,
@@ -181,6 +241,7 @@ class PlaybookResultCallBack(CallbackBase):
 
     def v2_runner_on_unreachable(self, res, **kwargs):
         self.gather_result(res)
+        super().v2_runner_on_unreachable(res, **kwargs)
 
     def v2_runner_on_skipped(self, res, **kwargs):
         self.gather_result(res)
@@ -0,0 +1,121 @@
+# ~*~ coding: utf-8 ~*~
+import atexit
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+__all__ = [
+    'SSHControlPool', 'get_control_pool', 'close_control_pool',
+]
+
+CONTROL_DIR_RE = re.compile(r'^chain-cp-(\d+)$')
+
+
+class SSHControlPool:
+    """
+    Per-worker pool of OpenSSH ControlMaster sockets, one per (user, host, port).
+    Idle masters exit by themselves after `persist` seconds (ControlPersist),
+    the oldest masters are closed when there are more than `max_masters`.
+    The control dir is removed by cleanup() when the worker process exits.
+    """
+
+    def __init__(self, control_dir=None, persist=300, max_masters=200):
+        self.control_dir = control_dir or os.path.join(
+            tempfile.gettempdir(), 'chain-cp-{}'.format(os.getpid()))
+        self.persist = persist
+        self.max_masters = max_masters
+        os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+
+    @property
+    def control_path(self):
+        return os.path.join(self.control_dir, '%r@%h:%p')
+
+    def apply(self, options):
+        """
+        :param options: Options
+        :return: Options with ssh args using the pooled control sockets
+        """
+        # ssh_args (ansible.cfg, default "-C -o ControlMaster=auto -o ControlPersist=60s") are left alone
+        # and come first on the command line: ssh uses the first value of an option,
+        # so persist only applies when ssh_args do not set ControlPersist
+        ssh_common_args = '{} -o ControlPersist={}s -o ControlPath={}'.format(
+            options.ssh_common_args or '', self.persist, self.control_path)
+        return options._replace(ssh_common_args=ssh_common_args.strip())
+
+    def sockets(self):
+        try:
+            names = os.listdir(self.control_dir)
+        except OSError:
+            return []
+        sockets = []
+        for name in names:
+            path = os.path.join(self.control_dir, name)
+            try:
+                sockets.append((os.stat(path).st_mtime, path))
+            except OSError:
+                continue
+        return sorted(sockets)
+
+    def close(self, path):
+        subprocess.call(['ssh', '-o', 'ControlPath={}'.format(path), '-O', 'exit', 'chain'],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def prune(self):
+        """
+        Close the oldest masters above max_masters
+        """
+        sockets = self.sockets()
+        for mtime, path in sockets[:max(0, len(sockets) - self.max_masters)]:
+            self.close(path)
+
+    def cleanup(self):
+        """
+        Close every master and remove the control dir
+        """
+        for mtime, path in self.sockets():
+            self.close(path)
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+
+    @staticmethod
+    def remove_stale_dirs(base_dir=None):
+        """
+        Remove control dirs left by worker processes that were killed without cleanup,
+        their masters exit by themselves after ControlPersist
+        """
+        base_dir = base_dir or tempfile.gettempdir()
+        for name in os.listdir(base_dir):
+            match = CONTROL_DIR_RE.match(name)
+            if not match or int(match.group(1)) == os.getpid():
+                continue
+            try:
+                os.kill(int(match.group(1)), 0)
+            except ProcessLookupError:
+                shutil.rmtree(os.path.join(base_dir, name), ignore_errors=True)
+            except OSError:
+                pass
+
+
+_pools = {}
+
+
+def get_control_pool(persist=300, max_masters=200):
+    """
+    One pool per worker process
+    """
+    pid = os.getpid()
+    if pid not in _pools:
+        SSHControlPool.remove_stale_dirs()
+        _pools[pid] = SSHControlPool(persist=persist, max_masters=max_masters)
+        atexit.register(close_control_pool)
+    return _pools[pid]
+
+
+def close_control_pool():
+    """
+    Clean up the pool of the current process, called on worker process shutdown
+    """
+    pool = _pools.pop(os.getpid(), None)
+    if pool is not None:
+        pool.cleanup()
@@ -35,36 +35,38 @@ class BaseHost(Host):
         hostname = host_data.get('hostname') or host_data.get('ip')
         port = host_data.get('port') or 22
         super().__init__(hostname, port)
-        self.__set_required_variables()
-        self.__set_extra_variables()
-
-    def __set_required_variables(self):
-        host_data = self.host_data
-        self.set_variable('ansible_host', host_data['ip'])
-        self.set_variable('ansible_port', host_data['port'])
+        # 一次性写入全部变量,  代替逐个 set_variable
+        self.vars.update(self.get_required_variables(host_data))
+        self.vars.update(host_data.get('vars') or {})
+
+    @staticmethod
+    def get_required_variables(host_data):
+        variables = {
+            'ansible_host': host_data['ip'],
+            'ansible_port': host_data['port'],
+        }
 
         if host_data.get('username'):
-            self.set_variable('ansible_user', host_data['username'])
+            variables['ansible_user'] = host_data['username']
 
         # 添加密码和秘钥
         if host_data.get('password'):
-            self.set_variable('ansible_ssh_pass', host_data['password'])
+            variables['ansible_ssh_pass'] = host_data['password']
         if host_data.get('private_key'):
-            self.set_variable('ansible_ssh_private_key_file', host_data['private_key'])
+            variables['ansible_ssh_private_key_file'] = host_data['private_key']
 
         # 添加become支持
         become = host_data.get("become", False)
         if become:
-            self.set_variable("ansible_become", True)
-            self.set_variable("ansible_become_method", become.get('method', 'sudo'))
-            self.set_variable("ansible_become_user", become.get('user', 'root'))
-            self.set_variable("ansible_become_pass", become.get('pass', ''))
+            variables.update({
+                "ansible_become": True,
+                "ansible_become_method": become.get('method', 'sudo'),
+                "ansible_become_user": become.get('user', 'root'),
+                "ansible_become_pass": become.get('pass', ''),
+            })
         else:
-            self.set_variable("ansible_become", False)
-
-    def __set_extra_variables(self):
-        for k, v in self.host_data.get('vars', {}).items():
-            self.set_variable(k, v)
+            variables["ansible_become"] = False
+        return variables
 
     def __repr__(self):
         return self.name
@@ -103,9 +105,10 @@ class BaseInventory(InventoryManager):
             host_list = []
         self.host_list = host_list
         assert isinstance(host_list, list)
+        # loader 和 variable_manager 与 runner 共用,  不再重复创建
         self.loader = self.loader_class()
-        self.variable_manager = self.variable_manager_class()
         super().__init__(self.loader)
+        self.variable_manager = self.variable_manager_class(loader=self.loader, inventory=self)
 
     def get_groups(self):
         return self._inventory.groups
@@ -1,5 +1,6 @@
 # ~*~ coding: utf-8 ~*~
 
+import logging
 import os
 from collections import namedtuple
 
@@ -11,12 +12,14 @@ from ansible.playbook.play import Play
 import ansible.constants as C
 
 from .callback import AdHocResultCallback, PlaybookResultCallBack, \
-    CommandResultCallback
+    CommandResultCallback, StreamResultCallback, FactsResultCallback
+from .connection import get_control_pool
 from .exceptions import AnsibleError
 
 
-__all__ = ["AdHocRunner", "PlayBookRunner"]
+__all__ = ["AdHocRunner", "PlayBookRunner", "FactsRunner"]
 C.HOST_KEY_CHECKING = False
+logger = logging.getLogger(__name__)
 
 
 Options = namedtuple('Options', [
@@ -58,6 +61,70 @@ def get_default_options():
     )
     return options
 
+
+def get_setting(name, default):
+    """
+    读取 django settings,  脱离 django 单独使用时 返回默认值
+    """
+    try:
+        from django.conf import settings
+        return getattr(settings, name, default)
+    except Exception:
+        return default
+
+
+def get_available_memory_mb():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES') // 1024 // 1024
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def get_adaptive_forks(host_count):
+    """
+    根据 主机数 / CPU / 可用内存 计算 forks,  范围由 settings 中的
+    ANSIBLE_FORKS_MIN / ANSIBLE_FORKS_MAX 限定
+    """
+    min_forks = get_setting('ANSIBLE_FORKS_MIN', 5)
+    max_forks = get_setting('ANSIBLE_FORKS_MAX', 100)
+    caps = [max_forks, (os.cpu_count() or 1) * get_setting('ANSIBLE_FORKS_PER_CPU', 10)]
+    memory = get_available_memory_mb()
+    if memory is not None:
+        caps.append(memory // get_setting('ANSIBLE_FORK_MEMORY_MB', 64))
+    forks = max(min_forks, min(caps))
+    return max(1, min(forks, host_count))
+
+
+def get_adaptive_options(options, host_count, timeout=None):
+    """
+    :param options: Options
+    :param host_count: inventory 主机数
+    :param timeout: 本次执行的 ssh 连接超时,  默认 settings.ANSIBLE_TIMEOUT
+    """
+    return options._replace(
+        forks=get_adaptive_forks(host_count),
+        timeout=timeout or get_setting('ANSIBLE_TIMEOUT', options.timeout),
+    )
+
+
+def get_pooled_options(options):
+    """
+    settings.ANSIBLE_SSH_CONTROL_PERSIST 开启时,  同一 worker 内 复用 ssh ControlMaster 连接
+    """
+    persist = get_setting('ANSIBLE_SSH_CONTROL_PERSIST', None)
+    if not persist or options.connection != 'ssh':
+        return options
+    pool = get_control_pool(persist, get_setting('ANSIBLE_SSH_CONTROL_MAX', 200))
+    pool.prune()
+    return pool.apply(options)
+
 #  执行 yml 文件
 
 
@@ -69,23 +136,30 @@ class PlayBookRunner:
     variable_manager_class = VariableManager
     options = get_default_options()
 
-    def __init__(self, playbook_path, inventory=None, options=None):
+    def __init__(self, playbook_path, inventory=None, options=None, timeout=None, max_unreachable=None):
         """
         :param options: Ansible options like ansible.cfg
         :param inventory: Ansible inventory
         :param BaseInventory:The BaseInventory parameter hostname must be equal to the hosts in yaml
         or the BaseInventory parameter groups must equal to the hosts in yaml.
+        :param timeout: ssh connect timeout of this run
+        :param max_unreachable: abort the run once this many hosts are unreachable
         """
         if options:
             self.options = options
+        else:
+            self.options = get_adaptive_options(self.options, len(inventory.hosts), timeout)
+        self.max_unreachable = max_unreachable or get_setting('ANSIBLE_MAX_UNREACHABLE', None)
         C.RETRY_FILES_ENABLED = False
         self.inventory = inventory
-        # self.loader = self.loader_class()
-        self.loader = DataLoader()
+        # 优先使用 BaseInventory 已创建的 loader 和 variable_manager
+        self.loader = getattr(inventory, 'loader', None) or self.loader_class()
         self.results_callback = self.results_callback_class()
         # self.playbook_path = options.playbook_path
         self.playbook_path = playbook_path
-        self.variable_manager = self.variable_manager_class(
+        # 可以传入多个 yml 文件,  在同一个 PlaybookExecutor 中依次执行
+        self.playbooks = playbook_path if isinstance(playbook_path, list) else [playbook_path]
+        self.variable_manager = getattr(inventory, 'variable_manager', None) or self.variable_manager_class(
             loader=self.loader, inventory=self.inventory
         )
         # self.passwords = options.passwords
@@ -101,20 +175,31 @@ class PlayBookRunner:
         if not self.inventory.list_hosts('all'):
             raise AnsibleError('Inventory is empty')
 
-    def run(self):
+    def execute(self, playbooks=None, results_callback=None):
+        """
+        :param playbooks: yml 文件,  默认 self.playbooks
+        :param results_callback: 默认 self.results_callback
+        """
+        results_callback = results_callback or self.results_callback
         executor = PlaybookExecutor(
-            playbooks=[self.playbook_path],
+            playbooks=playbooks or self.playbooks,
             inventory=self.inventory,
             variable_manager=self.variable_manager,
             loader=self.loader,
-            options=self.options,
+            options=get_pooled_options(self.options),
             passwords=self.passwords
         )
 
         if executor._tqm:
-            executor._tqm._stdout_callback = self.results_callback
-        executor.run()
-        executor._tqm.cleanup()
+            executor._tqm._stdout_callback = results_callback
+            results_callback.set_unreachable_limit(executor._tqm, self.max_unreachable)
+        try:
+            executor.run()
+        finally:
+            executor._tqm.cleanup()
+
+    def run(self):
+        self.execute()
         try:
             results_callback = self.results_callback.output['plays'][0]['tasks'][1]['hosts']
             status = self.results_callback.output['stats']
@@ -126,23 +211,59 @@ class PlayBookRunner:
                 'The hostname parameter or groups parameter in the BaseInventory \
                                does not match the hosts parameter in the yaml file.{}'.format(e))
 
+    @staticmethod
+    def get_play_hosts(play):
+        # 与 run() 相同,  取 Gathering Facts 之后的 第一个任务
+        tasks = play['tasks']
+        if len(tasks) > 1:
+            return tasks[1]['hosts']
+        return tasks[0]['hosts'] if tasks else {}
+
+    def run_all(self):
+        """
+        依次执行全部 yml 文件,  按文件返回结果
+        每个文件 使用 独立的 PlaybookExecutor / TQM,  共用 inventory 和 variable_manager:
+        PlaybookExecutor 在一个文件 有失败时 不再执行 后面的文件,  TQM 也会跳过 之前失败/不可达 的主机
+        :return: [{"hostname": result}, ...]  与 self.playbooks 一一对应,  执行出错的文件 为 {}
+        """
+        results = []
+        for path in self.playbooks:
+            results_callback = self.results_callback_class()
+            try:
+                self.execute([path], results_callback)
+            except Exception as e:
+                logger.error('{0} {1}'.format(path, e))
+            plays = results_callback.results
+            results.append(self.get_play_hosts(plays[0]) if plays else {})
+        return results
+
 
 class AdHocRunner:
     """
     ADHoc Runner接口
     """
     results_callback_class = AdHocResultCallback
+    stream_callback_class = StreamResultCallback
     loader_class = DataLoader
     variable_manager_class = VariableManager
     options = get_default_options()
     default_options = get_default_options()
 
-    def __init__(self, inventory, options=None):
+    def __init__(self, inventory, options=None, timeout=None, max_unreachable=None):
+        """
+        :param options: Ansible options, default forks/timeout are sized for the inventory
+        :param timeout: ssh connect timeout of this run
+        :param max_unreachable: abort the run once this many hosts are unreachable
+        """
         if options:
             self.options = options
+        else:
+            self.options = get_adaptive_options(self.options, len(inventory.hosts), timeout)
+        self.max_unreachable = max_unreachable or get_setting('ANSIBLE_MAX_UNREACHABLE', None)
         self.inventory = inventory
-        self.loader = DataLoader()
-        self.variable_manager = VariableManager(
+        # 优先使用 BaseInventory 已创建的 loader 和 variable_manager
+        self.loader = getattr(inventory, 'loader', None) or self.loader_class()
+        self.variable_manager = getattr(inventory, 'variable_manager', None) or self.variable_manager_class(
             loader=self.loader, inventory=self.inventory
         )
 
@@ -180,16 +301,19 @@ class AdHocRunner:
             tasks,
             pattern,
             play_name='Ansible Ad-hoc',
-            gather_facts='no',):
+            gather_facts='no',
+            results_callback=None,):
         """
         :param gather_facts:
         :param tasks: [{'action': {'module': 'shell', 'args': 'ls'}, ...}, ]
         :param pattern: all, *, or others
         :param play_name: The play name
+        :param results_callback: callback instance, default results_callback_class()
         :return:
         """
         self.check_pattern(pattern)
-        results_callback = self.results_callback_class()
+        if results_callback is None:
+            results_callback = self.results_callback_class()
         cleaned_tasks = self.clean_tasks(tasks)
 
         play_source = dict(
@@ -209,10 +333,11 @@ class AdHocRunner:
             inventory=self.inventory,
             variable_manager=self.variable_manager,
             loader=self.loader,
-            options=self.options,
+            options=get_pooled_options(self.options),
             stdout_callback=results_callback,
             passwords=self.options.passwords,
         )
+        results_callback.set_unreachable_limit(tqm, self.max_unreachable)
 
         try:
             tqm.run(play)
@@ -223,6 +348,23 @@ class AdHocRunner:
             tqm.cleanup()
             self.loader.cleanup_all_tmp_files()
 
+    def stream(self, tasks, pattern, sink, **kwargs):
+        """
+        Streaming mode: every host result goes to sink, nothing is kept in memory
+        :param sink: tasks.ansible_2420.sink.BaseSink instance, closed after the run
+        """
+        try:
+            return self.run(tasks, pattern, results_callback=self.stream_callback_class(sink), **kwargs)
+        finally:
+            sink.close()
+
+
+class FactsRunner(AdHocRunner):
+    """
+    stream() keeps ansible_facts of setup results
+    """
+    stream_callback_class = FactsResultCallback
+
 
 class CommandRunner(AdHocRunner):
     results_callback_class = CommandResultCallback
@@ -0,0 +1,142 @@
+# ~*~ coding: utf-8 ~*~
+import json
+
+import redis
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+
+__all__ = [
+    'BaseSink', 'TeeSink', 'CollectSink', 'ChannelSink',
+    'RedisStreamSink', 'BatchSink', 'format_event',
+]
+
+
+def format_event(event):
+    """
+    Render a trimmed event as the text shown to users
+    """
+    if event.get('stdout') or event.get('stderr'):
+        return "{0}{1}".format(event.get('stdout') or '', event.get('stderr') or '')
+    return "{0}".format(event.get('msg') or '')
+
+
+class BaseSink:
+    """
+    Receive trimmed host events from StreamResultCallback
+    event example: {
+        "status": "ok|failed|unreachable|skipped",
+        "hostname": "", "task": "",
+        "stdout": "", "stderr": "", "rc": 0, "msg": "",
+    }
+    """
+
+    def emit(self, event):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class TeeSink(BaseSink):
+    """
+    Send every event to several sinks
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def emit(self, event):
+        for sink in self.sinks:
+            sink.emit(event)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+class CollectSink(BaseSink):
+    """
+    Keep only the rendered text per host and task: {"hostname": {"task": "text"}}
+    Hosts that went unreachable are kept in unreachable: {"hostname": "task"},
+    ansible runs no later task of the play on them
+    """
+
+    def __init__(self, formatter=format_event):
+        self.formatter = formatter
+        self.results = {}
+        self.unreachable = {}
+
+    def emit(self, event):
+        self.results.setdefault(event['hostname'], {})[event['task']] = self.formatter(event)
+        if event['status'] == 'unreachable':
+            self.unreachable.setdefault(event['hostname'], event['task'])
+
+    def get(self, hostname, task):
+        return self.results.get(hostname, {}).get(task)
+
+
+class ChannelSink(BaseSink):
+    """
+    Push every event to a channels group, message status 2 is a host result
+    """
+
+    def __init__(self, group, job_id):
+        self.group = group
+        self.job_id = job_id
+        self.channel_layer = get_channel_layer()
+
+    def send(self, message):
+        async_to_sync(self.channel_layer.group_send)(
+            self.group, {"type": "user.message", "text": json.dumps(message)})
+
+    def emit(self, event):
+        self.send({
+            "status": 2,
+            "job": self.job_id,
+            "hostname": event['hostname'],
+            "task": event['task'],
+            "data": format_event(event),
+        })
+
+
+class RedisStreamSink(BaseSink):
+    """
+    Append every event to a redis stream (XADD), capped by maxlen
+    """
+
+    def __init__(self, key, url='redis://localhost:6379/0', maxlen=10000):
+        self.key = key
+        self.maxlen = maxlen
+        self.conn = redis.StrictRedis.from_url(url)
+
+    def emit(self, event):
+        fields = []
+        for k, v in event.items():
+            fields.extend([k, '' if v is None else v])
+        self.conn.execute_command('XADD', self.key, 'MAXLEN', '~', self.maxlen, '*', *fields)
+
+
+class BatchSink(BaseSink):
+    """
+    Buffer events and hand them to writer(events) every batch_size events,
+    e.g. a writer doing Model.objects.bulk_create
+    """
+
+    def __init__(self, writer, batch_size=200):
+        self.writer = writer
+        self.batch_size = batch_size
+        self.buffer = []
+
+    def emit(self, event):
+        self.buffer.append(event)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.writer(self.buffer)
+            self.buffer = []
+
+    def close(self):
+        self.flush()
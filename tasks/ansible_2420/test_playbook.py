@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+python -m unittest tasks.ansible_2420.test_playbook
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from tasks.ansible_2420.inventory import BaseInventory
+from tasks.ansible_2420.runner import PlayBookRunner, get_default_options
+
+
+FAIL_ON_B = """
+- hosts: all
+  gather_facts: no
+  tasks:
+    - name: first
+      fail:
+        msg: fail on b
+      when: inventory_hostname == 'b'
+"""
+
+ECHO = """
+- hosts: all
+  gather_facts: no
+  tasks:
+    - name: second
+      debug:
+        msg: "second {{ inventory_hostname }}"
+"""
+
+
+class PlayBookRunnerRunAllTest(unittest.TestCase):
+    """
+    一个 yml 在某台主机 失败,  后面的 yml 仍在 全部主机 执行
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.paths = []
+        for name, content in (('first.yml', FAIL_ON_B), ('second.yml', ECHO)):
+            path = os.path.join(self.tmp, name)
+            with open(path, 'w') as f:
+                f.write(content)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def get_inventory(self):
+        local = {'ansible_connection': 'local', 'ansible_python_interpreter': sys.executable}
+        return BaseInventory([
+            {'hostname': name, 'ip': '127.0.0.1', 'port': 22, 'vars': local} for name in ('a', 'b')
+        ])
+
+    def test_later_playbook_runs_after_failure(self):
+        options = get_default_options()._replace(playbook_path=self.tmp, forks=2)
+        runner = PlayBookRunner(playbook_path=self.paths, inventory=self.get_inventory(), options=options)
+        first, second = runner.run_all()
+
+        self.assertIn('skip_reason', first['a'])
+        self.assertEqual(first['b']['msg'], 'fail on b')
+        self.assertEqual(sorted(second), ['a', 'b'])
+        self.assertEqual(second['b']['msg'], 'second b')
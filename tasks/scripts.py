@@ -0,0 +1,122 @@
+import hashlib
+import logging
+import os
+import re
+import time
+
+from django.conf import settings
+
+from tasks.models import Tools
+
+__all__ = [
+    'normalize_script',
+    'script_path',
+    'get_script',
+    'ensure_script',
+    'clean_scripts',
+]
+
+logger = logging.getLogger('tasks')
+
+SCRIPT_DIR = getattr(settings, 'SCRIPT_STORE_DIR', os.path.join(settings.BASE_DIR, 'data', 'script'))
+SCRIPT_MAX_SIZE = getattr(settings, 'SCRIPT_STORE_MAX_SIZE', 64 * 1024 * 1024)
+SCRIPT_NAME_RE = re.compile(r'^[0-9a-f]{40}\.(sh|yml)$')
+# 旧版本 每次执行 生成的 时间戳+随机数 文件名,  超过 LEGACY_MAX_AGE 秒 即删除
+LEGACY_NAME_RE = re.compile(r'^\d+\.(sh|yml)$')
+LEGACY_MAX_AGE = 24 * 3600
+# 命中缓存时 超过该秒数才刷新 mtime,  用于 LRU 清理
+TOUCH_INTERVAL = 3600
+
+
+def normalize_script(script):
+    """
+    去掉 windows 换行中的 \r,  代替原来的 sed 's/\r//'
+    """
+    return (script or '').replace('\r', '')
+
+
+def script_suffix(tool_run_type):
+    return '.yml' if tool_run_type == 'yml' else '.sh'
+
+
+def script_path(script, tool_run_type):
+    """
+    脚本内容的 sha1 作为文件名,  内容相同的脚本 共用一个文件
+    """
+    digest = hashlib.sha1(normalize_script(script).encode('utf-8')).hexdigest()
+    return os.path.join(SCRIPT_DIR, digest + script_suffix(tool_run_type))
+
+
+def get_script(tool):
+    """
+    获取工具脚本的 文件路径,  不存在时写入,  已存在则直接复用
+    :param tool:  Tools 对象
+    :return:  脚本路径
+    """
+    path = script_path(tool.tool_script, tool.tool_run_type)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        write_script(path, normalize_script(tool.tool_script))
+        clean_scripts()
+    else:
+        if time.time() - mtime > TOUCH_INTERVAL:
+            os.utime(path, None)
+    return path
+
+
+def ensure_script(path):
+    """
+    worker 执行前 确认脚本文件 仍存在:  路径在提交时确定,  排队期间 可能已被 clean_scripts 删除,
+    此时 按文件名(内容的 sha1) 从 Tools 找回脚本 重新写入
+    :return:  脚本路径
+    """
+    if os.path.exists(path):
+        return path
+    for tool in Tools.objects.only('tool_script', 'tool_run_type').iterator():
+        if script_path(tool.tool_script, tool.tool_run_type) == path:
+            write_script(path, normalize_script(tool.tool_script))
+            break
+    else:
+        logger.error('脚本 {0} 不存在,  对应的工具 已修改或删除'.format(path))
+    return path
+
+
+def write_script(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def clean_scripts(max_size=SCRIPT_MAX_SIZE):
+    """
+    脚本目录 超过 max_size 时,  按最近使用时间(mtime) 从旧到新 删除,  被删除后 仍排队的任务 由 ensure_script 重新写入
+    旧版本 遗留的 随机文件名脚本 超过 LEGACY_MAX_AGE 直接删除
+    """
+    files = []
+    now = time.time()
+    for name in os.listdir(SCRIPT_DIR):
+        legacy = LEGACY_NAME_RE.match(name)
+        if not legacy and not SCRIPT_NAME_RE.match(name):
+            continue
+        path = os.path.join(SCRIPT_DIR, name)
+        try:
+            stat = os.stat(path)
+            if legacy and now - stat.st_mtime > LEGACY_MAX_AGE:
+                os.remove(path)
+                continue
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(f[1] for f in files)
+    for mtime, size, path in sorted(files):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError as e:
+            logger.error(e)
@@ -0,0 +1,23 @@
+from celery.signals import worker_process_shutdown
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from tasks.ansible_2420.connection import close_control_pool
+from tasks.models import Tools
+from tasks.scripts import get_script
+
+
+@receiver(post_save, sender=Tools)
+def tools_saved(sender, instance, **kwargs):
+    """
+    工具保存时 预先写入脚本文件,  执行时直接复用
+    """
+    get_script(instance)
+
+
+@worker_process_shutdown.connect
+def worker_process_exit(**kwargs):
+    """
+    celery 子进程 退出时 不会执行 atexit,  关闭 ssh ControlMaster 并删除 控制目录
+    """
+    close_control_pool()
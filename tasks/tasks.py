@@ -1,123 +1,327 @@
 from multiprocessing import current_process
 from asset.models import AssetInfo
-from tasks.ansible_2420.runner import AdHocRunner, PlayBookRunner
+from asset.bulk import bulk_update
+from tasks.ansible_2420.runner import AdHocRunner, PlayBookRunner, FactsRunner
 from tasks.ansible_2420.inventory import BaseInventory
+from tasks.ansible_2420.sink import CollectSink, ChannelSink, TeeSink, BatchSink
+from tasks.ansible_2420.exceptions import AnsibleError
 from tasks.models import Variable, Tools
+from tasks.scripts import get_script, ensure_script
 from index.password_crypt import decrypt_p
+import datetime
 import logging
-import os
-import random
+from itertools import groupby, zip_longest
 
-from celery import shared_task
+from celery import shared_task, group, chord
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
 
 
 logger = logging.getLogger('tasks_celery')
 
+HARDWARE_SYNC_LOCK = 'asset-hardware-sync'
+
+
+def format_tool(event):
+    """
+    工具执行结果  优先 stdout, 其次 stderr, 失败时 msg
+    """
+    return "{0}".format(event.get('stdout') or event.get('stderr') or event.get('msg') or '')
+
+
+def collect_tool(collect, hostname, task):
+    """
+    合并 play 中 一个工具 在一台主机上的 输出,  主机 在前面的工具 不可达时 后续工具 不会执行,  标明 跳过
+    """
+    out = collect.get(hostname, task)
+    if out is None and hostname in collect.unreachable:
+        return "主机不可达, 跳过 (在 {0} 时断开)".format(collect.unreachable[hostname])
+    return out
+
 
 @shared_task
 def ansbile_tools(assets, tasks):
+    """
+    执行工具,  相邻的 script 工具 合并为一个 play,  相邻的 yml 工具 共用 inventory 依次执行 (每个 yml 独立的 PlaybookExecutor)
+    :param assets:  资产帐号密码
+    :param tasks:  按优先级排序的工具任务,  name 唯一
+    :return:  [{hostname, data}]  先工具 后主机
+    """
     current_process()._config = {'semprefix': '/mp'}
 
-    inventory = BaseInventory(host_list=assets)
-    hostname, retsult_data = [], []
-    ret = None
-    for i in assets:
-        hostname.append(i['hostname'])
-
+    # 同一作业的 所有 play 共用一个 inventory / variable_manager
+    inventory = BaseInventory(assets)
+    hostname = [i['hostname'] for i in assets]
+    outputs = {}
     for t in tasks:
-        if t['action']['module'] == "script":
+        ensure_script(t['action']['args'])
+
+    for module, batch in groupby(tasks, key=lambda t: t['action']['module']):
+        batch = list(batch)
+        if module == "script":
             runner = AdHocRunner(inventory)
-            t1 = [t]
-            retsult = runner.run(t1, "all")
+            collect = CollectSink(format_tool)
             try:
-                ok = retsult.results_raw['ok']
-                failed = retsult.results_raw['failed']
-                unreachable = retsult.results_raw['unreachable']
-                if not ok and not failed:
-                    ret = unreachable
-                elif not ok:
-                    ret = failed
-                else:
-                    ret = ok
+                # 一个工具失败 不影响 后面的工具
+                runner.stream([dict(t, ignore_errors=True) for t in batch], "all", collect)
             except Exception as e:
                 logger.error("{}".format(e))
+            for t in batch:
+                outputs[t['name']] = {h: collect_tool(collect, h, t['name']) for h in hostname}
 
-            for i in range(len(hostname)):
-                std, ret_host = [], {}
-                try:
-                    out = ret[hostname[i]][t['name']]['stdout']
-                    if not out:
-                        out = ret[hostname[i]][t['name']]['stderr']
-                    std.append("{0}".format(out))
-                except Exception as e:
-                    logger.error(e)
-                    try:
-                        std.append("{0}".format(ret[hostname[i]][t['name']]['msg']))
-                    except Exception as e:
-                        logger.error("{0}执行失败{1}".format(t['name'], e))
-                ret_host['hostname'] = hostname[i]
-                ret_host['data'] = ''.join(std)
-                retsult_data.append(ret_host)
-
-        elif t['action']['module'] == 'yml':
-            runers = PlayBookRunner(playbook_path=t['action']['args'], inventory=inventory)
-            retsult = runers.run()
+        elif module == 'yml':
+            rets = []
             try:
-                ret = retsult['results_callback']
+                runers = PlayBookRunner(playbook_path=[t['action']['args'] for t in batch], inventory=inventory)
+                rets = runers.run_all()
             except Exception as e:
                 logger.error("{}".format(e))
+            for t, ret in zip_longest(batch, rets[:len(batch)], fillvalue={}):
+                outputs[t['name']] = {h: format_tool(ret[h]) if h in ret else None for h in hostname}
 
-            for i in range(len(hostname)):
-                std, ret_host = [], {}
-                try:
-                    out = ret[hostname[i]]['stdout']
-                    if not out:
-                        out = ret[hostname[i]]['stderr']
-                    std.append("{0}".format(out))
-                except Exception as e:
-                    logger.error(e)
-                    try:
-                        std.append("{0}".format(ret[hostname[i]]['msg']))
-                    except Exception as e:
-                        logger.error("{0}执行失败".format(e))
-                ret_host['hostname'] = hostname[i]
-                ret_host['data'] = ''.join(std)
-                retsult_data.append(ret_host)
-
+    retsult_data = []
+    for t in tasks:
+        if t['name'] not in outputs:
+            continue
+        for h in hostname:
+            out = outputs[t['name']][h]
+            if out is None:
+                logger.error("{0}执行失败 {1}".format(t['name'], h))
+                out = "执行失败, 无结果"
+            retsult_data.append({'hostname': h, 'data': out})
     return retsult_data
 
 
 @shared_task
-def ansbile_asset_hardware(ids, assets):
+def ansbile_tools_merge(results, sizes):
+    """
+    合并 分片执行的 ansbile_tools 结果,  保持 先工具 后主机 的顺序
+    :param results:  每个分片的结果 [[{hostname, data}], ...]
+    :param sizes:  每个分片的主机数
+    :return:  [{hostname, data}]
+    """
+    retsult_data = []
+    tool_count = max([len(r) // size for r, size in zip(results, sizes) if size] or [0])
+    for k in range(tool_count):
+        for r, size in zip(results, sizes):
+            retsult_data.extend(r[k * size:(k + 1) * size])
+    return retsult_data
+
+
+def ansbile_tools_fanout(assets, tasks, shard_size=None):
+    """
+    主机按 shard_size 分片,  以 celery chord 分发到多个 worker 并行执行, 最后合并结果
+    主机数不超过一个分片时 直接执行 ansbile_tools
+    :return:  AsyncResult,  其 task_id 对应合并后的结果
+    """
+    shard_size = shard_size or getattr(settings, 'TOOLS_SHARD_SIZE', 50)
+    if len(assets) <= shard_size:
+        return ansbile_tools.delay(assets, tasks)
+
+    shards = [assets[i:i + shard_size] for i in range(0, len(assets), shard_size)]
+    header = group(ansbile_tools.s(shard, tasks) for shard in shards)
+    return chord(header)(ansbile_tools_merge.s([len(shard) for shard in shards]))
+
+
+@shared_task(bind=True)
+def ansbile_cmd(self, user, assets, tasks):
+    """
+    执行 cmd 命令,  每台主机的结果 实时推送到 用户的 channels 组
+    :param user:  用户名 即 channels 组名
+    :param assets:  资产帐号密码
+    :param tasks:  执行的命令 和 模块
+    :return:  执行结果
+    """
     current_process()._config = {'semprefix': '/mp'}
 
+    channel = ChannelSink(user, self.request.id)
+    collect = CollectSink()
     inventory = BaseInventory(host_list=assets)
     runner = AdHocRunner(inventory)
+    try:
+        runner.stream(tasks, "all", TeeSink(channel, collect))
+    except Exception as e:
+        logger.error(e)
+        channel.send({"status": 3, "job": self.request.id, "error": "{}".format(e)})
+    else:
+        channel.send({"status": 3, "job": self.request.id, "error": None})
+
+    retsult_data = []
+    for host in inventory.hosts:
+        std = [collect.get(host, t['name']) for t in tasks]
+        retsult_data.append({'hostname': host, 'data': '\n'.join(i for i in std if i is not None)})
+    return retsult_data
+
+
+HARDWARE_FIELDS = ('disk', 'memory', 'cpu', 'system')
+
+
+def asset_host(asset):
+    """
+    资产 转为 inventory 主机,  需要 select_related('user')
+    """
+    return {
+        "hostname": asset.hostname,
+        "ip": asset.network_ip,
+        "port": asset.port,
+        "username": asset.user.username,
+        "password": decrypt_p(asset.user.password),
+        "private_key": asset.user.private_key.name,
+    }
+
+
+def parse_hardware(data):
+    """
+    setup 收集的 ansible_facts 转为 资产硬件字段
+    """
+    disk = "{}".format(str(sum([int(data["ansible_devices"][i]["sectors"]) *
+                                int(data["ansible_devices"][i]["sectorsize"]) / 1024 / 1024 / 1024
+                                for i in data["ansible_devices"] if
+                                i[0:2] in ("vd", "ss", "sd")])) + str(" GB"))
+    mem = round(data['ansible_memtotal_mb'] / 1024)
+    cpu = int("{}".format(data['ansible_processor_count'] * data["ansible_processor_cores"]))
+    lsb = data.get('ansible_lsb', {}).get("description") or "{0} {1}".format(
+        data.get('ansible_distribution', ''), data.get('ansible_distribution_version', ''))
+    system = data['ansible_product_name'] + "" + lsb
+    return {'disk': disk, 'memory': "{}".format(mem), 'cpu': "{}".format(cpu), 'system': system}
+
+
+class HardwareWriter:
+    """
+    BatchSink 的 writer,  一批 setup 结果 解析后 用 bulk_update 写回 AssetInfo
+    only_changed 时 只写 硬件信息有变化的行,  未变化的行 只更新 hardware_time 记录本次检查时间,  不改动 utime
+    """
+
+    def __init__(self, only_changed=False):
+        self.only_changed = only_changed
+        self.updated, self.unchanged, self.failed = [], [], []
+
+    def __call__(self, events):
+        rows = {}
+        for event in events:
+            try:
+                if event['status'] != 'ok':
+                    raise AnsibleError(event.get('msg') or event['status'])
+                rows[event['hostname']] = parse_hardware(event['ansible_facts'])
+            except Exception as e:
+                logger.error("获取资产信息 {0} 失败 {1}".format(event['hostname'], e))
+                self.failed.append(event['hostname'])
+
+        now = timezone.now()
+        objs, unchanged = [], []
+        for asset in AssetInfo.objects.filter(hostname__in=rows).values('id', 'hostname', *HARDWARE_FIELDS):
+            hardware = rows[asset['hostname']]
+            if self.only_changed and all(asset[k] == hardware[k] for k in HARDWARE_FIELDS):
+                unchanged.append(asset)
+                continue
+            objs.append(AssetInfo(id=asset['id'], utime=now, hardware_time=now, **hardware))
+
+        bulk_update(AssetInfo, objs, HARDWARE_FIELDS + ('utime', 'hardware_time'))
+        if unchanged:
+            AssetInfo.objects.filter(id__in=[i['id'] for i in unchanged]).update(hardware_time=now)
+        self.updated.extend(obj.hostname for obj in objs)
+        self.unchanged.extend(i['hostname'] for i in unchanged)
+
+
+def collect_hardware(assets, writer):
+    """
+    一个 play 收集全部主机的 hardware 事实 (gather_subset 只取 hardware),  结果按批交给 writer
+    """
+    inventory = BaseInventory(host_list=assets)
+    runner = FactsRunner(inventory)
     tasks = [
-        {"action": {"module": "setup", "args": ""}, "name": "script"},
+        {"action": {"module": "setup", "args": "gather_subset=!all,hardware"}, "name": "setup"},
     ]
-    retsult = runner.run(tasks, "all")
-    hostname = assets[0]['hostname']
+    runner.stream(tasks, "all", BatchSink(writer))
+
+
+@shared_task
+def ansbile_asset_hardware(assets):
+    """
+    批量 更新资产硬件信息
+    :param assets:  资产帐号密码  asset_host()
+    :return:  执行结果
+    """
+    current_process()._config = {'semprefix': '/mp'}
 
+    writer = HardwareWriter()
     try:
-        data = retsult.results_raw['ok'][hostname]['script']['ansible_facts']
-        disk = "{}".format(str(sum([int(data["ansible_devices"][i]["sectors"]) *
-                                    int(data["ansible_devices"][i]["sectorsize"]) / 1024 / 1024 / 1024
-                                    for i in data["ansible_devices"] if
-                                    i[0:2] in ("vd", "ss", "sd")])) + str(" GB"))
-        mem = round(data['ansible_memtotal_mb'] / 1024)
-        cpu = int("{}".format(data['ansible_processor_count'] * data["ansible_processor_cores"]))
-
-        system = data['ansible_product_name'] + "" + data['ansible_lsb']["description"]
-        AssetInfo.objects.filter(id=ids).update(hostname=hostname,
-                                                disk=disk,
-                                                memory=mem,
-                                                cpu=cpu,
-                                                system=system)
+        collect_hardware(assets, writer)
     except Exception as e:
         logger.error(e)
-        return "获取资产信息 {0} 失败 {1}".format(hostname,e)
-    return "获取资产信息 {} 成功".format(hostname)
+        return "获取资产信息失败 {0}".format(e)
+    return "获取资产信息 成功 {0} 失败 {1} {2}".format(len(writer.updated), len(writer.failed), ' '.join(writer.failed))
+
+
+def hardware_stale(max_age):
+    """
+    硬件信息 需要同步的资产:  hardware_time 早于 max_age 秒前 或 从未同步
+    """
+    cutoff = timezone.now() - datetime.timedelta(seconds=max_age)
+    return AssetInfo.objects.filter(is_active=True, user__isnull=False).filter(
+        Q(hardware_time__lt=cutoff) | Q(hardware_time__isnull=True))
+
+
+@shared_task
+def ansbile_hardware_shard(last_id, max_age, shard_size, interval=0):
+    """
+    同步 id 大于 last_id 的 下一个分片 资产硬件信息,  只写 有变化的行
+    完成后 间隔 interval 秒 以本分片 最大id 为游标 排队 下一个分片,  broker 中 同时只有一个 分片消息,
+    countdown 不会超过 visibility_timeout
+    :param last_id:  游标,  上一个分片的 最大资产ID
+    :param max_age:  秒,  分片排队期间 已被同步的资产 跳过
+    :param shard_size:  每个分片的 资产数
+    """
+    current_process()._config = {'semprefix': '/mp'}
+
+    ids = list(hardware_stale(max_age).filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:shard_size])
+    if not ids:
+        cache.delete(HARDWARE_SYNC_LOCK)
+        return "同步资产信息 完成"
+    try:
+        return sync_hardware_shard(ids)
+    finally:
+        ansbile_hardware_shard.apply_async((ids[-1], max_age, shard_size, interval), countdown=interval)
+
+
+def sync_hardware_shard(ids):
+    qs = AssetInfo.objects.filter(id__in=ids).select_related('user')
+    assets = [asset_host(i) for i in qs if i.user is not None]
+    if not assets:
+        return "同步资产信息 无需更新"
+
+    writer = HardwareWriter(only_changed=True)
+    try:
+        collect_hardware(assets, writer)
+    except Exception as e:
+        logger.error(e)
+        return "同步资产信息失败 {0}".format(e)
+    return "同步资产信息 更新 {0} 未变化 {1} 失败 {2}".format(
+        len(writer.updated), len(writer.unchanged), len(writer.failed))
+
+
+@shared_task
+def ansbile_hardware_sync(max_age=None, shard_size=None, interval=None):
+    """
+    周期任务 增量同步 全部资产的硬件信息,  可在 周期任务 中添加 tasks.tasks.ansbile_hardware_sync
+    hardware_time 在 max_age 秒内的资产 跳过,  其余按 id 顺序 每 shard_size 台 一个分片,
+    每个分片 完成后 间隔 interval 秒 执行下一个,  上一轮的分片 未执行完时 本次跳过
+    :return:  待同步的资产数
+    """
+    max_age = max_age or getattr(settings, 'HARDWARE_SYNC_MAX_AGE', 24 * 3600)
+    shard_size = shard_size or getattr(settings, 'HARDWARE_SYNC_SHARD_SIZE', 50)
+    interval = getattr(settings, 'HARDWARE_SYNC_INTERVAL', 60) if interval is None else interval
+
+    count = hardware_stale(max_age).count()
+    if not count:
+        return "同步资产信息 无需更新"
+    # worker 异常退出时 锁 在 max_age 后过期
+    if not cache.add(HARDWARE_SYNC_LOCK, count, max_age):
+        return "同步资产信息 上一轮 尚未完成"
+    ansbile_hardware_shard.delay(0, max_age, shard_size, interval)
+    return "同步资产信息 {0} 台 每个分片 {1} 台".format(count, shard_size)
 
 
 @shared_task
@@ -153,23 +357,12 @@ def ansbile_tools_crontab(tools_name, *args):
             "vars": var_all,
         }, )
 
-    file = "data/script/{0}".format(random.randint(0, 999999))
-    file2 = "data/script/{0}".format(random.randint(1000000, 9999999))
-
     tools, modules = None, None
     if t_obj.tool_run_type == 'shell' or t_obj.tool_run_type == 'python':
-        with open("{}.sh".format(file), 'w+') as f:
-            f.write(t_obj.tool_script)
-        os.system(
-            "sed  's/\r//'  {0}.sh >  {1}.sh".format(file, file2))
-        tools = '{}.sh'.format(file2)
+        tools = get_script(t_obj)
         modules = "script"
     elif t_obj.tool_run_type == 'yml':
-
-        with open("{}.yml".format(file), 'w+') as f:
-            f.write(t_obj.tool_script)
-        os.system("sed  's/\r//'  {0}.yml >  {1}.yml".format(file, file2))
-        tools = '{}.yml'.format(file2)
+        tools = get_script(t_obj)
         modules = "yml"
 
     inventory = BaseInventory(host_list=assets_list)
@@ -182,37 +375,17 @@ def ansbile_tools_crontab(tools_name, *args):
     if modules == "script":
         runner = AdHocRunner(inventory)
         tasks = [{"action": {"module": "{}".format(modules), "args": "{}".format(tools)}, "name": "script"}, ]
-        retsult = runner.run(tasks, "all")
-
+        collect = CollectSink(format_tool)
         try:
-            ok = retsult.results_raw['ok']
-            failed = retsult.results_raw['failed']
-            unreachable = retsult.results_raw['unreachable']
-            if not ok and not failed:
-                ret = unreachable
-            elif not ok:
-                ret = failed
-            else:
-                ret = ok
+            runner.stream(tasks, "all", collect)
         except Exception as e:
             logger.error("{}".format(e))
 
         for i, element in enumerate(hostname):
-            std, ret_host = [], {}
-            try:
-                out = ret[element]['script']['stdout']
-                if not out:
-                    out = ret[element]['script']['stderr']
-                std.append("{0}".format(out))
-            except Exception as e:
-                logger.error(e)
-                try:
-                    std.append("{0}".format(ret[element]['script']['msg']))
-                except Exception as e:
-                    logger.error("执行失败{0}".format(e))
-            ret_host['hostname'] = element
-            ret_host['data'] = ''.join(std)
-            retsult_data.append(ret_host)
+            out = collect.get(element, 'script')
+            if out is None:
+                logger.error("执行失败 {0}".format(element))
+            retsult_data.append({'hostname': element, 'data': out or ''})
 
     elif modules == 'yml':
         runers = PlayBookRunner(playbook_path=tools, inventory=inventory)
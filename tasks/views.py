@@ -4,22 +4,49 @@ from django.urls import reverse_lazy
 from django.views.generic import ListView, View, CreateView, UpdateView, DetailView
 from django.db.models import Q
 from asset.models import AssetInfo, AssetProject
+from asset.bulk import check_ids
+from asset.permission import get_project_ids, has_project_perm
 from tasks.models import cmd_list, Tools, ToolsResults, Variable
 from tasks.form import ToolsForm, VarsForm
-from tasks.tasks import ansbile_tools
+from tasks.scripts import get_script
+from tasks.tasks import ansbile_tools_fanout, ansbile_cmd, asset_host
 from django_celery_results.models import TaskResult
 from index.password_crypt import decrypt_p
 from chain import settings
 from name.models import Names
-from tasks.ansible_2420.runner import AdHocRunner
-from tasks.ansible_2420.inventory import BaseInventory
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
-import json, datetime, paramiko, os, logging, random, time
+import json, datetime, paramiko, os, logging
 
 logger = logging.getLogger('tasks')
 from pure_pagination import PageNotAnInteger, Paginator
 
+
+def get_cmd_assets(user, ids):
+    """
+    校验主机ID 和 执行权限 (一次查询),  资产 / 登录用户 / 项目 / 变量组 各一次查询取出
+    :return:  (有权限的资产 每个带 host 即 inventory 主机,  {id: 状态})
+    """
+    allowed, outcomes = check_ids(AssetInfo, ids, get_project_ids(user, 'cmd_assetproject'))
+    asset_obj = list(AssetInfo.objects.filter(id__in=allowed).select_related('user', 'project'))
+
+    host_vars = {}
+    for asset_id, var in Variable.objects.filter(assets__id__in=allowed).values_list('assets__id', 'vars'):
+        host_vars.setdefault(asset_id, []).append(var)
+
+    for i in asset_obj:
+        var_all = {
+            'hostname': i.hostname,
+            'inner_ip': i.inner_ip,
+            "network_ip": i.network_ip,
+            "project": i.project.projects}
+        # 与 Variable.objects.get 一致,  只关联一个变量组时 生效
+        if len(host_vars.get(i.id, [])) == 1:
+            var_all.update(host_vars[i.id][0] or {})
+        i.host = dict(asset_host(i), vars=var_all) if i.user is not None else None
+    return asset_obj, outcomes
+
+
 class TasksCmd(LoginRequiredMixin, ListView):
     """
     任务cmd 界面
@@ -43,14 +70,8 @@ class TasksCmd(LoginRequiredMixin, ListView):
         """
          资产查询功能
         """
-        name = Names.objects.get(username=self.request.user)
-        self.queryset = super().get_queryset()
-        for i in self.queryset:
-            project = AssetInfo.objects.get(hostname=i)
-            project_obj = AssetProject.objects.filter(projects=project)
-            hasperm = name.has_perm('cmd_assetproject', project_obj)
-            if not hasperm:
-                self.queryset.delete(i)
+        project_ids = get_project_ids(self.request.user, 'cmd_assetproject')
+        self.queryset = super().get_queryset().filter(project_id__in=project_ids)
 
         if self.request.GET.get('project'):
             project = self.request.GET.get('project', None)
@@ -87,14 +108,8 @@ class TasksTail(LoginRequiredMixin, ListView):
         """
          资产查询功能
         """
-        name = Names.objects.get(username=self.request.user)
-        self.queryset = super().get_queryset()
-        for i in self.queryset:
-            project = AssetInfo.objects.get(hostname=i)
-            project_obj = AssetProject.objects.filter(projects=project)
-            hasperm = name.has_perm('cmd_assetproject', project_obj)
-            if not hasperm:
-                self.queryset.delete(i)
+        project_ids = get_project_ids(self.request.user, 'cmd_assetproject')
+        self.queryset = super().get_queryset().filter(project_id__in=project_ids)
 
         if self.request.GET.get('project'):
             project = self.request.GET.get('project', None)
@@ -108,58 +123,6 @@ class TasksTail(LoginRequiredMixin, ListView):
         return self.queryset
 
 
-def cmdjob(assets, tasks):
-    """
-    :param assets:  资产帐号密码
-    :param tasks:  执行的命令 和 模块
-    :return:  执行结果
-    """
-
-    inventory = BaseInventory(host_list=assets)
-    hostname = []
-    for i in inventory.hosts:
-        hostname.append(i)
-    runner = AdHocRunner(inventory)
-    retsult = runner.run(tasks, "all")
-    ret = None
-    try:
-        ok = retsult.results_raw['ok']
-        failed = retsult.results_raw['failed']
-        unreachable = retsult.results_raw['unreachable']
-        if not ok and not failed:
-            ret = unreachable
-        elif not ok:
-            ret = failed
-        else:
-            ret = ok
-    except Exception as e:
-        logger.error("{}".format(e))
-
-    retsult_data = []
-
-    for i, element in enumerate(hostname):
-        std, ret_host = [], {}
-        for t in range(len(tasks)):
-            try:
-                out = ret[element]['task{}'.format(t)]['stdout']
-                err = ret[element]['task{}'.format(t)]['stderr']
-                std.append("{0}{1}".format(out, err))
-            except Exception as e:
-                logger.error(e)
-                try:
-                    std.append("{0} \n".format(
-                        ret[hostname[i]]['task{}'.format(t)]['msg'], t + 1))
-                except Exception as e:
-                    logger.error("第{0}个执行失败,此任务后面的任务未执行 {1}".format(t + 1, e))
-                    std.append("第{0}个执行失败,此任务后面的任务未执行".format(t + 1))
-
-        ret_host['hostname'] = element
-        ret_host['data'] = '\n'.join(std)
-        retsult_data.append(ret_host)
-
-    return retsult_data
-
-
 def taillog(request, hostname, port, username, password, private, tail):
     """
     执行 tail log 接口
@@ -191,7 +154,6 @@ class TasksPerform(LoginRequiredMixin, View):
 
     @staticmethod
     def post(request):
-        name = Names.objects.get(username=request.user)
         ids = request.POST.getlist('id')
         args = request.POST.getlist('args', None)
         modules = request.POST.getlist('module', None)
@@ -201,15 +163,9 @@ class TasksPerform(LoginRequiredMixin, View):
             ret_data['data'].append(ret)
             return HttpResponse(json.dumps(ret_data))
 
-        idstring = ','.join(ids)
-        asset_obj = AssetInfo.objects.extra(where=['id IN (' + idstring + ')'])
-
-        for i in asset_obj:
-            project = AssetInfo.objects.get(hostname=i).project
-            project_obj = AssetProject.objects.get(projects=project)
-            hasperm = name.has_perm('cmd_assetproject', project_obj)
-            if not hasperm:
-                return HttpResponse(status=500)
+        asset_obj, outcomes = get_cmd_assets(request.user, ids)
+        if set(outcomes.values()) & {'forbidden', 'invalid'}:
+            return HttpResponse(status=500)
 
         tasks, assets = [], []
         for x in range(len(modules)):
@@ -217,36 +173,15 @@ class TasksPerform(LoginRequiredMixin, View):
                 {"action": {"module": modules[x], "args": args[x]}, "name": 'task{}'.format(x)}, )
 
         for i in asset_obj:
-            try:
-                i.user.hostname
-            except Exception as e:
-                logger.error(e)
+            if i.user is None:
                 ret = {
                     'hostname': i.hostname,
-                    'data': '未关联用户,请关联后再操作  {0}'.format(e)}
+                    'data': '未关联用户,请关联后再操作'}
                 ret_data['data'].append(ret)
                 return HttpResponse(json.dumps(ret_data))
-
-            var_all = {
-                'hostname': i.hostname,
-                'inner_ip': i.inner_ip,
-                "network_ip": i.network_ip,
-                "project": i.project.projects}
-            try:
-                var_all.update(Variable.objects.get(assets__hostname=i).vars)
-            except Exception as e:
-                pass
-            assets.append({
-                "hostname": i.hostname,
-                "ip": i.network_ip,
-                "port": i.port,
-                "username": i.user.username,
-                "password": decrypt_p(i.user.password),
-                "private_key": i.user.private_key.name,
-                "vars": var_all,
-            }, )
-        t = cmdjob(assets, tasks)
-        ret_data['data'] = t
+            assets.append(i.host)
+        rets = ansbile_cmd.delay(request.user.username, assets, tasks)
+        ret_data['job'] = rets.task_id
         return HttpResponse(json.dumps(ret_data))
 
 
@@ -256,7 +191,6 @@ def taskstailperform(request):
     """
     if request.method == "POST":
         ret = {'status': True, 'error': None, }
-        name = Names.objects.get(username=request.user)
         ids = request.POST.get('id')
         tail = request.POST.get('tail', None)
 
@@ -266,8 +200,7 @@ def taskstailperform(request):
             return HttpResponse(json.dumps(ret))
 
         asset_obj = AssetInfo.objects.get(id=ids)
-        project_obj = AssetProject.objects.get(projects=asset_obj.project)
-        hasperm = name.has_perm('cmd_assetproject', project_obj)
+        hasperm = has_project_perm(request.user, 'cmd_assetproject', asset_obj.project_id)
         if not hasperm:
             return HttpResponse(status=500)
         try:
@@ -393,14 +326,8 @@ class ToolsExec(LoginRequiredMixin, ListView):
         """
          资产查询功能
         """
-        name = Names.objects.get(username=self.request.user)
-        self.queryset = super().get_queryset()
-        for i in self.queryset:
-            project = AssetInfo.objects.get(hostname=i)
-            project_obj = AssetProject.objects.filter(projects=project)
-            hasperm = name.has_perm('cmd_assetproject', project_obj)
-            if not hasperm:
-                self.queryset.delete(i)
+        project_ids = get_project_ids(self.request.user, 'cmd_assetproject')
+        self.queryset = super().get_queryset().filter(project_id__in=project_ids)
 
         if self.request.GET.get('project'):
             project = self.request.GET.get('project', None)
@@ -437,38 +364,15 @@ class ToolsExec(LoginRequiredMixin, ListView):
                     ret['error'] = '优先级设置有重复 ,请重新修改！！！'
                     return HttpResponse(json.dumps(ret))
 
-            asset_id_tring = ','.join(asset_id)
-            asset_obj = AssetInfo.objects.extra(where=['id IN (' + asset_id_tring + ')'])
-
-            for i in asset_obj:
-                project = AssetInfo.objects.get(hostname=i).project
-                project_obj = AssetProject.objects.get(projects=project)
-                hasperm = name.has_perm('cmd_assetproject', project_obj)
-                if not hasperm:
-                    return HttpResponse(status=500)
-
-            assets = []
-            for i in asset_obj:
-                var_all = {
-                    'hostname': i.hostname,
-                    'inner_ip': i.inner_ip,
-                    "network_ip": i.network_ip,
-                    "project": i.project.projects
-                }
-                try:
-                    var_all.update(Variable.objects.get(assets__hostname=i).vars)
-                except Exception as e:
-                    pass
-
-                assets.append({
-                    "hostname": i.hostname,
-                    "ip": i.network_ip,
-                    "port": i.port,
-                    "username": i.user.username,
-                    "password": decrypt_p(i.user.password),
-                    "private_key": i.user.private_key.name,
-                    "vars": var_all,
-                }, )
+            asset_obj, outcomes = get_cmd_assets(request.user, asset_id)
+            if set(outcomes.values()) & {'forbidden', 'invalid'}:
+                return HttpResponse(status=500)
+            no_user = [i.hostname for i in asset_obj if i.host is None]
+            if no_user:
+                ret['status'] = False
+                ret['error'] = '未关联用户,请关联后再操作 {0}'.format(' '.join(no_user))
+                return HttpResponse(json.dumps(ret))
+            assets = [i.host for i in asset_obj]
 
             tool_priority_1 = dict(zip(tool_id, priority))
             tool_priority = sorted(tool_priority_1.items(), key=lambda item: item[1])
@@ -477,28 +381,14 @@ class ToolsExec(LoginRequiredMixin, ListView):
             for i in tool_priority:
                 tool_obj = Tools.objects.get(id=i[0])
                 if tool_obj.tool_run_type == 'shell' or tool_obj.tool_run_type == 'python':
-                    t = time.time()
-                    file = "data/script/{0}".format(int(round(t * 1000)) + random.randint(0, 999999))
-                    t1 = time.time()
-                    file2 = "data/script/{0}".format(int(round(t1 * 1000)) + random.randint(10000000, 99999999))
-                    with open("{}.sh".format(file), 'w+') as f:
-                        f.write(tool_obj.tool_script)
-                    os.system("sed  's/\r//'  {0}.sh >  {1}.sh".format(file, file2))
-                    tasks.append({"action": {"module": "script", "args": '{}.sh'.format(file2), },
+                    tasks.append({"action": {"module": "script", "args": get_script(tool_obj), },
                                   "name": 'task{}'.format(i[1])}, )
 
                 elif tool_obj.tool_run_type == 'yml':
-                    t = time.time()
-                    file = "data/script/{0}".format(int(round(t * 1000)) + random.randint(0, 999999))
-                    t1 = time.time()
-                    file2 = "data/script/{0}".format(int(round(t1 * 1000)) + random.randint(10000000, 99999999))
-                    with open("{}.yml".format(file), 'w+') as f:
-                        f.write(tool_obj.tool_script)
-                    os.system("sed  's/\r//'  {0}.yml >  {1}.yml".format(file, file2))
-                    tasks.append({"action": {"module": "yml", "args": '{}.yml'.format(file2), },
+                    tasks.append({"action": {"module": "yml", "args": get_script(tool_obj), },
                                   "name": 'task{}'.format(i[1])}, )
 
-            rets = ansbile_tools.delay(assets, tasks)
+            rets = ansbile_tools_fanout(assets, tasks)
             task_obj = ToolsResults.objects.create(task_id=rets.task_id, add_user=name)
             ret['id'] = task_obj.id
             return HttpResponse(json.dumps(ret))
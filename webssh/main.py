@@ -1,3 +1,5 @@
+import contextlib
+import hmac
 import io
 import logging
 import os.path
@@ -5,8 +7,12 @@ import socket
 import traceback
 import uuid
 import weakref
+from concurrent.futures import ThreadPoolExecutor
 import paramiko
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
 import tornado.websocket
 from tornado.ioloop import IOLoop
@@ -14,6 +20,11 @@ from tornado.iostream import _ERRNO_CONNRESET
 from tornado.options import define, options, parse_command_line
 from tornado.util import errno_from_exception
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 
 define('address', default='0.0.0.0', help='listen address')
 define('port', default=8002, help='listen port', type=int)
@@ -21,11 +32,42 @@ define('debug', default=False, help='debug mode', type=bool)
 define('policy', default='warning',
        help='missing host key policy, reject|autoadd|warning')
 define('period', default=10, help='seconds for periodic callback', type=int)
-
-
-BUF_SIZE = 1024
+define('maxconn', default=20, type=int,
+       help='max ssh connections being established at the same time per process')
+define('processes', default=1, type=int,
+       help='number of processes, 0 for cpu count; process N also listens on ws_base_port+N for websockets')
+define('metrics_token', default='',
+       help='token for /metrics (?token= or Authorization: Bearer), empty allows localhost only')
+define('ws_base_port', default=8100, type=int,
+       help='first per-process websocket port when processes != 1, must not overlap other services')
+
+
+BUF_SIZE = 4096              # 初始 读取大小,  按实际读取量 在 BUF_SIZE ~ MAX_BUF_SIZE 之间 自适应
+MAX_BUF_SIZE = 64 * 1024
+FLUSH_SIZE = 64 * 1024       # 合并的输出 超过该大小 立即发送
+FLUSH_INTERVAL = 0.008       # 秒,  连续输出时 合并在一个 websocket 帧中 发送的间隔
+HIGH_WATER = 256 * 1024      # websocket 待发送数据 超过该值 暂停读取 ssh channel,  发送完后 恢复
 DELAY = 3
 workers = {}
+task_id = None               # 多进程时 当前进程的 序号
+executor = None              # 建立 ssh 连接 的线程池,  IOLoop 线程 只做 非阻塞 IO
+sessions = {}                # 已连接 websocket 的 worker,  用于 /metrics 的 会话统计
+metrics = dict(
+    sessions_total=0,
+    bytes_in=0,              # 浏览器 -> ssh
+    bytes_out=0,             # ssh -> 浏览器
+    frames_in=0,
+    frames_out=0,
+    flush_latency_sum=0.0,   # 秒,  数据 从 channel 读出 到 写入 websocket 的 等待时间
+    flush_latency_max=0.0,
+)
+
+
+def log_debug():
+    """
+    终端数据 热路径上 先判断日志级别,  未开启 debug 时 不构造日志参数
+    """
+    return logging.root.isEnabledFor(logging.DEBUG)
 
 from cryptography.fernet import Fernet
 
@@ -46,10 +88,24 @@ class Worker(object):
         self.chan = chan
         self.dst_addr = dst_addr
         self.fd = chan.fileno()
-        self.id = str(id(self))
+        self.id = '{}-{}'.format(task_id or 0, id(self))
         self.data_to_dst = []
         self.handler = None
         self.mode = IOLoop.READ
+        self.read_size = BUF_SIZE
+        self.data_to_src = []
+        self.pending = 0
+        self.last_flush = 0
+        self.flush_timeout = None
+        self.want_mode = IOLoop.READ
+        self.paused = False
+        self.buffer_since = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+        self.flush_latency_sum = 0.0
+        self.flush_latency_max = 0.0
 
     def __call__(self, fd, events):
         if events & IOLoop.READ:
@@ -64,37 +120,142 @@ class Worker(object):
             self.handler = handler
 
     def update_handler(self, mode):
+        self.want_mode = mode
+        if self.paused:
+            mode &= ~IOLoop.READ
         if self.mode != mode:
             self.loop.update_handler(self.fd, mode)
             self.mode = mode
 
-    def on_read(self):
-        logging.debug('worker {} on read'.format(self.id))
+    def write_buffer_size(self):
         try:
-            data = self.chan.recv(BUF_SIZE)
-        except (OSError, IOError) as e:
-            logging.error(e)
-            if errno_from_exception(e) in _ERRNO_CONNRESET:
-                self.close()
-        else:
-            logging.debug('"{}" from {}:{}'.format(data, *self.dst_addr))
+            return len(self.handler.ws_connection.stream._write_buffer)
+        except (AttributeError, TypeError):   # 连接关闭后 ws_connection / _write_buffer 为 None
+            return 0
+
+    def pause_reading(self, future):
+        """
+        浏览器接收慢时 不再读取 channel,  远端 由 ssh 窗口 控制流量, 每个会话的内存 有上限
+        :param future:  最后一次 write_message 返回的 Future,  完成时 之前的数据 都已发送
+        """
+        if self.paused:
+            return
+        logging.debug('worker %s pause reading', self.id)
+        self.paused = True
+        self.update_handler(self.want_mode)
+        self.loop.add_future(future, self.on_drained)
+
+    def on_drained(self, future):
+        # 连接关闭时 Future 带 StreamClosedError,  取出 避免 未处理异常 的日志
+        future.exception()
+        self.resume_reading()
+
+    def resume_reading(self):
+        if not self.paused or self.chan.closed:
+            return
+        logging.debug('worker %s resume reading', self.id)
+        self.paused = False
+        self.update_handler(self.want_mode)
+
+    def on_read(self):
+        """
+        读空 channel (最多 FLUSH_SIZE),  读满时 加大下次的读取大小,  读不满时 减小
+        """
+        if log_debug():
+            logging.debug('worker %s on read', self.id)
+        while self.pending < FLUSH_SIZE:
+            try:
+                data = self.chan.recv(self.read_size)
+            except socket.timeout:
+                break
+            except (OSError, IOError) as e:
+                logging.error(e)
+                if errno_from_exception(e) in _ERRNO_CONNRESET:
+                    self.close()
+                    return
+                break
+
+            if log_debug():
+                logging.debug('"%s" from %s:%s', data, *self.dst_addr)
             if not data:
+                self.flush()
                 self.close()
                 return
 
-            logging.debug('"{}" to {}:{}'.format(data, *self.handler.src_addr))
-            try:
-                self.handler.write_message(data)
-            except tornado.websocket.WebSocketClosedError:
-                self.close()
+            if not self.data_to_src:
+                self.buffer_since = self.loop.time()
+            self.data_to_src.append(data)
+            self.pending += len(data)
+            if len(data) < self.read_size:
+                self.read_size = max(self.read_size // 2, BUF_SIZE)
+                break
+            self.read_size = min(self.read_size * 2, MAX_BUF_SIZE)
+
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        """
+        距上次发送 超过 FLUSH_INTERVAL (交互输入的回显) 立即发送,
+        连续输出时 FLUSH_INTERVAL 内的数据 合并为一帧,  超过 FLUSH_SIZE 立即发送
+        """
+        if not self.data_to_src:
+            return
+        if self.pending >= FLUSH_SIZE:
+            self.flush()
+        elif self.flush_timeout is None:
+            if self.loop.time() - self.last_flush >= FLUSH_INTERVAL:
+                self.flush()
+            else:
+                self.flush_timeout = self.loop.call_later(FLUSH_INTERVAL, self.flush)
+
+    def flush(self):
+        if self.flush_timeout is not None:
+            self.loop.remove_timeout(self.flush_timeout)
+            self.flush_timeout = None
+        if not self.data_to_src or not self.handler:
+            return
+
+        data = b''.join(self.data_to_src)
+        self.data_to_src = []
+        self.pending = 0
+        self.last_flush = self.loop.time()
+        if log_debug():
+            logging.debug('"%s" to %s:%s', data, *self.handler.src_addr)
+        try:
+            future = self.handler.write_message(data)
+        except tornado.websocket.WebSocketClosedError:
+            self.close()
+            return
+        self.count_out(len(data), self.last_flush - self.buffer_since)
+        self.buffer_since = None
+        if future is not None and self.write_buffer_size() > HIGH_WATER:
+            self.pause_reading(future)
+
+    def count_in(self, size):
+        self.bytes_in += size
+        self.frames_in += 1
+        metrics['bytes_in'] += size
+        metrics['frames_in'] += 1
+
+    def count_out(self, size, latency):
+        self.bytes_out += size
+        self.frames_out += 1
+        self.flush_latency_sum += latency
+        self.flush_latency_max = max(self.flush_latency_max, latency)
+        metrics['bytes_out'] += size
+        metrics['frames_out'] += 1
+        metrics['flush_latency_sum'] += latency
+        metrics['flush_latency_max'] = max(metrics['flush_latency_max'], latency)
 
     def on_write(self):
-        logging.debug('worker {} on write'.format(self.id))
+        if log_debug():
+            logging.debug('worker %s on write', self.id)
         if not self.data_to_dst:
             return
 
         data = ''.join(self.data_to_dst)
-        logging.debug('"{}" to {}:{}'.format(data, *self.dst_addr))
+        if log_debug():
+            logging.debug('"%s" to %s:%s', data, *self.dst_addr)
 
         try:
             sent = self.chan.send(data)
@@ -115,6 +276,10 @@ class Worker(object):
 
     def close(self):
         logging.debug('Closing worker {}'.format(self.id))
+        sessions.pop(self.id, None)
+        if self.flush_timeout is not None:
+            self.loop.remove_timeout(self.flush_timeout)
+            self.flush_timeout = None
         if self.handler:
             self.loop.remove_handler(self.fd)
             self.handler.close()
@@ -163,12 +328,11 @@ class IndexHandler(MixinHandler, tornado.web.RequestHandler):
     #     return data.decode('utf-8')
 
 
-    def get_privatekey(self):       ##修改上传KEY 改为 获取 key 路径
+    def get_privatekey(self, path):       ##修改上传KEY 改为 获取 key 路径
         try:
-            data1 = '{0}'.format(self.get_argument('privatekey'))
+            data1 = '{0}'.format(path)
             with open(data1)  as file_object:
                 data = file_object.read()
-            print(data)
             return data
         except Exception as  e:
             data = None
@@ -223,59 +387,78 @@ class IndexHandler(MixinHandler, tornado.web.RequestHandler):
         port = self.get_port()
         username = self.get_value('username')
         password = self.get_argument('password')
-        privatekey = self.get_privatekey()
-        pkey = self.get_pkey(privatekey, password) if privatekey else None
-        args = (hostname, port, username, decrypt_p(password), pkey)
-        logging.debug(args)
-        return args
+        privatekey = self.get_argument('privatekey', None)
+        logging.debug('ssh %s@%s:%s', username, hostname, port)
+        return hostname, port, username, password, privatekey
 
     def get_client_addr(self):
         return super(IndexHandler, self).get_client_addr() or self.request.\
                 connection.stream.socket.getpeername()
 
-    def ssh_connect(self):
+    def ssh_connect(self, args, host_keys):
+        """
+        在 executor 线程中 执行:  读取/解析 私钥,  连接,  打开 shell
+        host_keys 是 settings['host_keys'] 的副本,  autoadd 只写入副本,  由 post 在 IOLoop 线程 合并
+        :return:  (ssh, chan, dst_addr)
+        """
+        hostname, port, username, password, privatekey = args
+        privatekey = self.get_privatekey(privatekey) if privatekey else None
+        pkey = self.get_pkey(privatekey, password) if privatekey else None
+
         ssh = paramiko.SSHClient()
         ssh._system_host_keys = self.settings['system_host_keys']
-        ssh._host_keys = self.settings['host_keys']
+        ssh._host_keys = host_keys
         ssh.set_missing_host_key_policy(self.settings['policy'])
 
-        args = self.get_args()
-        dst_addr = (args[0], args[1])
+        dst_addr = (hostname, port)
         logging.info('Connecting to {}:{}'.format(*dst_addr))
 
         try:
-            ssh.connect(*args, timeout=6)
-        except socket.error:
-            raise ValueError('Unable to connect to {}:{}'.format(*dst_addr))
-        except paramiko.BadAuthenticationType:
-            raise ValueError('Authentication failed.')
-        except paramiko.BadHostKeyException:
-            raise ValueError('Bad host key.')
-
-        chan = ssh.invoke_shell(term='xterm')
-        chan.setblocking(0)
-        worker = Worker(ssh, chan, dst_addr)
-        IOLoop.current().call_later(DELAY, recycle, worker)
-        return worker
+            try:
+                ssh.connect(hostname, port, username, decrypt_p(password), pkey, timeout=6)
+            except socket.error:
+                raise ValueError('Unable to connect to {}:{}'.format(*dst_addr))
+            except paramiko.BadAuthenticationType:
+                raise ValueError('Authentication failed.')
+            except paramiko.BadHostKeyException:
+                raise ValueError('Bad host key.')
+
+            chan = ssh.invoke_shell(term='xterm')
+            chan.setblocking(0)
+        except Exception:
+            ssh.close()
+            raise
+        return ssh, chan, dst_addr
 
     def get(self):
         self.render('index.html')
 
-    def post(self):
+    async def post(self):
         worker_id = None
         status = None
 
+        host_keys = copy_host_keys(self.settings['host_keys'])
+        known = len(host_keys._entries)
         try:
-            worker = self.ssh_connect()
+            args = self.get_args()
+            ssh, chan, dst_addr = await IOLoop.current().run_in_executor(
+                executor, self.ssh_connect, args, host_keys)
         except Exception as e:
             logging.error(traceback.format_exc())
             status = str(e)
         else:
+            # Worker 绑定 当前线程的 IOLoop,  须在 IOLoop 线程 创建
+            worker = Worker(ssh, chan, dst_addr)
+            IOLoop.current().call_later(DELAY, recycle, worker)
             worker.src_addr = self.get_client_addr()
             worker_id = worker.id
             workers[worker_id] = worker
+        finally:
+            merge_host_keys(self.settings['host_keys'], host_keys._entries[known:])
 
-        self.write(dict(id=worker_id, status=status))
+        # ssh 连接 只存在于 创建它的进程,  多进程时 websocket 须连到 该进程 独占的端口
+        port = get_process_port() if task_id is not None else None
+        self.write(dict(id=worker_id, status=status, port=port))
 
 
 class WsockHandler(MixinHandler, tornado.websocket.WebSocketHandler):
@@ -311,14 +494,18 @@ class WsockHandler(MixinHandler, tornado.websocket.WebSocketHandler):
             workers.pop(worker.id)
             self.set_nodelay(True)
             worker.set_handler(self)
+            sessions[worker.id] = worker
+            metrics['sessions_total'] += 1
             self.worker_ref = weakref.ref(worker)
             self.loop.add_handler(worker.fd, worker, IOLoop.READ)
         else:
             self.close()
 
     def on_message(self, message):
-        logging.debug('"{}" from {}:{}'.format(message, *self.src_addr))
+        if log_debug():
+            logging.debug('"%s" from %s:%s', message, *self.src_addr)
         worker = self.worker_ref()
+        worker.count_in(len(message.encode('utf-8') if isinstance(message, str) else message))
         worker.data_to_dst.append(message)
         worker.on_write()
 
@@ -329,6 +516,43 @@ class WsockHandler(MixinHandler, tornado.websocket.WebSocketHandler):
             worker.close()
 
 
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Prometheus 文本格式 的 计数,  全局 与 每个会话,  只含 本进程 的数据,  以 process 标签 区分
+    多进程时 共享的 port 由 任意一个进程 应答,  应分别抓取 每个进程的 ws_base_port+N
+    仅允许 本机 访问,  或 携带 --metrics_token
+    """
+    COUNTERS = ('bytes_in', 'bytes_out', 'frames_in', 'frames_out', 'flush_latency_sum')
+    LOCAL_ADDRS = ('127.0.0.1', '::1')
+
+    def check_access(self):
+        if options.metrics_token:
+            auth = self.request.headers.get('Authorization', '')
+            token = auth[len('Bearer '):] if auth.startswith('Bearer ') else self.get_argument('token', '')
+            return hmac.compare_digest(token.encode('utf-8'), options.metrics_token.encode('utf-8'))
+        return self.request.remote_ip in self.LOCAL_ADDRS
+
+    def get(self):
+        if not self.check_access():
+            raise tornado.web.HTTPError(403)
+        process = 'process="{}"'.format(task_id or 0)
+        lines = [
+            'webssh_sessions_total{{{}}} {}'.format(process, metrics['sessions_total']),
+            'webssh_sessions_active{{{}}} {}'.format(process, len(sessions)),
+            'webssh_workers_pending{{{}}} {}'.format(process, len(workers)),
+            'webssh_flush_latency_max{{{}}} {:.6f}'.format(process, metrics['flush_latency_max']),
+        ]
+        lines.extend('webssh_{}{{{}}} {}'.format(name, process, metrics[name]) for name in self.COUNTERS)
+        for worker in list(sessions.values()):
+            labels = '{},id="{}"'.format(process, worker.id)
+            lines.extend('webssh_session_{}{{{}}} {}'.format(name, labels, getattr(worker, name))
+                         for name in self.COUNTERS)
+            lines.append('webssh_session_flush_latency_max{{{}}} {:.6f}'.format(labels, worker.flush_latency_max))
+            lines.append('webssh_session_paused{{{}}} {}'.format(labels, int(worker.paused)))
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write('\n'.join(lines) + '\n')
+
+
 def recycle(worker):
     if worker.handler:
         return
@@ -343,11 +567,48 @@ def get_host_keys(path):
     return paramiko.hostkeys.HostKeys()
 
 
+def copy_host_keys(host_keys):
+    """
+    浅拷贝 条目列表,  autoadd 只会 追加新条目,  不修改 已有条目
+    """
+    copied = paramiko.hostkeys.HostKeys()
+    copied._entries = list(host_keys._entries)
+    return copied
+
+
+def merge_host_keys(host_keys, entries):
+    for entry in entries:
+        for hostname in entry.hostnames:
+            host_keys.add(hostname, entry.key.get_name(), entry.key)
+
+
+@contextlib.contextmanager
+def host_keys_lock(filename):
+    """
+    多进程 共用 一个 known_hosts,  读取-合并-写入 期间 持有 filename.lock 的 排他锁
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(filename + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def save_host_keys(host_keys, filename):
+    """
+    本进程 新增的 主机密钥 合并到 文件中 已有的密钥 (其他进程 写入的) 后 再保存
+    """
     length = len(host_keys)
     if length != host_keys._last_len:
         logging.info('Updating {}'.format(filename))
-        host_keys.save(filename)
+        with host_keys_lock(filename):
+            merged = get_host_keys(filename)
+            merge_host_keys(merged, host_keys._entries)
+            merged.save(filename)
         host_keys._last_len = length
 
 
@@ -366,6 +627,10 @@ def get_policy_class(policy):
     return cls
 
 
+def get_process_port():
+    return options.ws_base_port + task_id
+
+
 def get_application_settings():
     base_dir = os.path.dirname(__file__)
     filename = os.path.join(base_dir, 'known_hosts')
@@ -375,8 +640,8 @@ def get_application_settings():
     logging.info(policy_class.__name__)
 
     if policy_class is paramiko.client.AutoAddPolicy:
-        host_keys.save(filename)  # for permission test
-        host_keys._last_len = len(host_keys)
+        host_keys._last_len = -1
+        save_host_keys(host_keys, filename)  # for permission test
         tornado.ioloop.PeriodicCallback(
             lambda: save_host_keys(host_keys, filename),
             options.period * 1000  # milliseconds
@@ -400,17 +665,38 @@ def get_application_settings():
 
 
 def main():
+    """
+    --processes=1  单进程
+    --processes=N  (0 为 cpu 核数)  fork N 个进程 共享 port 接收登录请求,
+    第 N 个进程 另外监听 ws_base_port+N,  登录返回的 port 即 该会话 websocket 应连接的端口
+    """
+    global task_id, executor
     parse_command_line()
+    sockets = None
+    if options.processes != 1:
+        sockets = tornado.netutil.bind_sockets(options.port, options.address)
+        task_id = tornado.process.fork_processes(options.processes)
+
+    # IOLoop 和 线程池 须在 fork 之后 创建
+    executor = ThreadPoolExecutor(max_workers=options.maxconn)
     settings = get_application_settings()
 
     handlers = [
         (r'/',   IndexHandler),
-        (r'/ws', WsockHandler)
+        (r'/ws', WsockHandler),
+        (r'/metrics', MetricsHandler),
     ]
 
     app = tornado.web.Application(handlers, **settings)
-    app.listen(options.port, options.address)
-    logging.info('Listening on {}:{}'.format(options.address, options.port))
+    if sockets is None:
+        app.listen(options.port, options.address)
+        logging.info('Listening on {}:{}'.format(options.address, options.port))
+    else:
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_sockets(sockets)
+        server.listen(get_process_port(), options.address)
+        logging.info('Process {} listening on {}:{} and {}'.format(
+            task_id, options.address, options.port, get_process_port()))
     IOLoop.current().start()
 
 
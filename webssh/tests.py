@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+python -m unittest discover -s webssh -p tests.py
+"""
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import paramiko
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.iostream import _StreamBuffer
+from tornado.options import options
+from tornado.testing import AsyncHTTPTestCase, AsyncTestCase, gen_test
+from tornado.web import Application
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main  # noqa: E402
+
+
+class FakeChan(object):
+    closed = False
+
+    def fileno(self):
+        return 99
+
+
+class FakeHandler(object):
+    """
+    write_message 把数据 放入 真实的 IOStream 写缓冲,  返回的 Future 由测试 控制完成
+    """
+    src_addr = ('127.0.0.1', 50000)
+
+    def __init__(self):
+        self.ws_connection = mock.Mock()
+        self.ws_connection.stream._write_buffer = _StreamBuffer()
+        self.futures = []
+
+    def write_message(self, data):
+        self.ws_connection.stream._write_buffer.append(data)
+        future = Future()
+        self.futures.append(future)
+        return future
+
+    def drain(self):
+        self.ws_connection.stream._write_buffer = _StreamBuffer()
+        for future in self.futures:
+            future.set_result(None)
+
+
+class WorkerBackpressureTest(AsyncTestCase):
+
+    def setUp(self):
+        super(WorkerBackpressureTest, self).setUp()
+        self.worker = main.Worker(mock.Mock(), FakeChan(), ('10.0.0.1', 22))
+        self.worker.loop = mock.Mock(wraps=self.io_loop)
+        self.worker.loop.update_handler = mock.Mock()   # fd 99 并未 注册到 IOLoop
+        self.worker.handler = FakeHandler()
+
+    def send(self, size):
+        self.worker.data_to_src.append(b'x' * size)
+        self.worker.pending += size
+        self.worker.buffer_since = self.io_loop.time()
+        self.worker.flush()
+
+    def test_no_pause_below_high_water(self):
+        self.send(main.HIGH_WATER)
+        self.assertFalse(self.worker.paused)
+        self.worker.loop.update_handler.assert_not_called()
+
+    @gen_test
+    def test_pause_until_write_drained(self):
+        self.send(main.HIGH_WATER + 1)
+        self.assertTrue(self.worker.paused)
+        self.worker.loop.update_handler.assert_called_with(99, 0)
+
+        # 暂停期间 写事件 不应 重新注册 读事件
+        self.worker.update_handler(IOLoop.READ)
+        self.assertEqual(self.worker.mode, 0)
+
+        self.worker.handler.drain()
+        yield gen.sleep(0.01)
+        self.assertFalse(self.worker.paused)
+        self.worker.loop.update_handler.assert_called_with(99, IOLoop.READ)
+
+    @gen_test
+    def test_closed_connection_does_not_resume(self):
+        self.send(main.HIGH_WATER + 1)
+        self.worker.chan.closed = True
+        self.worker.handler.futures[-1].set_exception(main.tornado.websocket.WebSocketClosedError())
+        yield gen.sleep(0.01)
+        self.assertTrue(self.worker.paused)
+        self.assertEqual(self.worker.loop.update_handler.call_count, 1)
+
+
+class FakeRecvChan(FakeChan):
+    """
+    ready 中 每一项 是 一次到达的数据量,  recv 最多取 size,  没有数据时 与 非阻塞 channel 一样 抛出 socket.timeout
+    """
+
+    def __init__(self):
+        self.ready = []
+        self.sizes = []
+
+    def recv(self, size):
+        self.sizes.append(size)
+        if not self.ready:
+            raise socket.timeout()
+        take = min(self.ready[0], size)
+        if take == self.ready[0]:
+            self.ready.pop(0)
+        else:
+            self.ready[0] -= take
+        return b'x' * take
+
+
+class WorkerFlushTest(unittest.TestCase):
+    """
+    IOLoop 的 time / call_later 由测试 控制,  flush 的时机 不依赖 真实时间
+    """
+
+    def setUp(self):
+        self.now = 1000.0
+        self.timers = []
+        self.frames = []
+        self.worker = main.Worker(mock.Mock(), FakeRecvChan(), ('10.0.0.1', 22))
+        self.worker.loop = mock.Mock()
+        self.worker.loop.time.side_effect = lambda: self.now
+        self.worker.loop.call_later.side_effect = self.call_later
+        self.worker.loop.remove_timeout.side_effect = self.remove_timeout
+        self.worker.handler = FakeHandler()
+        self.worker.handler.write_message = self.write_message
+
+    def call_later(self, delay, callback):
+        timer = [self.now + delay, callback]
+        self.timers.append(timer)
+        return timer
+
+    def remove_timeout(self, timer):
+        if timer in self.timers:
+            self.timers.remove(timer)
+
+    def advance(self, seconds):
+        self.now += seconds
+        for timer in [i for i in self.timers if i[0] <= self.now]:
+            self.timers.remove(timer)
+            timer[1]()
+
+    def write_message(self, data):
+        self.frames.append((self.now, data))
+
+    def receive(self, *sizes):
+        self.worker.chan.ready.extend(sizes)
+        self.worker.on_read()
+
+    def test_keystroke_after_idle_flushes_immediately(self):
+        self.advance(1)
+        self.receive(1)
+        self.assertEqual(self.frames, [(self.now, b'x')])
+        self.worker.loop.call_later.assert_not_called()
+
+    def test_flood_one_frame_per_interval(self):
+        ticks = 80
+        for _ in range(ticks):
+            self.advance(0.001)
+            self.receive(200)
+        self.advance(main.FLUSH_INTERVAL)
+
+        self.assertEqual(sum(len(data) for _, data in self.frames), ticks * 200)
+        times = [t for t, _ in self.frames]
+        for previous, current in zip(times, times[1:]):
+            self.assertGreaterEqual(current - previous, main.FLUSH_INTERVAL - 1e-9)
+        self.assertLessEqual(len(self.frames), ticks * 0.001 / main.FLUSH_INTERVAL + 2)
+
+    def test_read_size_grows_and_shrinks(self):
+        self.receive(main.MAX_BUF_SIZE * 4)
+        self.assertEqual(self.worker.chan.sizes, [4096, 8192, 16384, 32768, 65536])
+        self.assertEqual(self.worker.read_size, main.MAX_BUF_SIZE)
+        self.assertEqual(len(self.frames), 1)   # 超过 FLUSH_SIZE 立即发送
+
+        self.worker.chan.ready = []
+        self.advance(1)
+        self.receive(10)
+        self.assertEqual(self.worker.read_size, main.MAX_BUF_SIZE // 2)
+        for _ in range(10):
+            self.advance(1)
+            self.receive(10)
+        self.assertEqual(self.worker.read_size, main.BUF_SIZE)
+
+
+class MetricsHandlerTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        return Application([(r'/metrics', main.MetricsHandler)])
+
+    def tearDown(self):
+        options.metrics_token = ''
+        main.sessions.clear()
+        super(MetricsHandlerTest, self).tearDown()
+
+    def test_localhost_without_token(self):
+        worker = main.Worker(mock.Mock(), FakeChan(), ('10.0.0.1', 22))
+        worker.count_in(len('中'.encode('utf-8')))
+        main.sessions[worker.id] = worker
+        response = self.fetch('/metrics')
+        self.assertEqual(response.code, 200)
+        body = response.body.decode('utf-8')
+        self.assertIn('webssh_bytes_in{process="0"} ', body)
+        self.assertIn('webssh_session_bytes_in{{process="0",id="{}"}} 3'.format(worker.id), body)
+        self.assertNotIn('10.0.0.1', body)
+
+    def test_token_required(self):
+        options.metrics_token = 'secret'
+        self.assertEqual(self.fetch('/metrics').code, 403)
+        self.assertEqual(self.fetch('/metrics?token=wrong').code, 403)
+        self.assertEqual(self.fetch('/metrics?token=secret').code, 200)
+        self.assertEqual(self.fetch('/metrics', headers={'Authorization': 'Bearer secret'}).code, 200)
+
+
+class SaveHostKeysTest(unittest.TestCase):
+    """
+    多个进程 各自 autoadd 的密钥 保存时 合并,  不互相覆盖
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, 'known_hosts')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def load(self):
+        host_keys = main.get_host_keys(self.filename)
+        host_keys._last_len = len(host_keys)
+        return host_keys
+
+    def test_merge_with_other_process(self):
+        first, second = self.load(), self.load()
+        first.add('10.0.0.1', 'ssh-rsa', paramiko.RSAKey.generate(1024))
+        second.add('10.0.0.2', 'ssh-rsa', paramiko.RSAKey.generate(1024))
+
+        main.save_host_keys(first, self.filename)
+        main.save_host_keys(second, self.filename)
+
+        saved = main.get_host_keys(self.filename)
+        self.assertEqual(sorted(saved.keys()), ['10.0.0.1', '10.0.0.2'])
+
+
+class SshConnectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = mock.Mock(settings=dict(
+            system_host_keys=paramiko.HostKeys(), host_keys=paramiko.HostKeys(), policy=paramiko.AutoAddPolicy()))
+        self.args = ('10.0.0.1', 22, 'root', None, None)
+
+    @mock.patch.object(main, 'decrypt_p', lambda password: password)
+    @mock.patch.object(main.paramiko, 'SSHClient')
+    def test_close_when_invoke_shell_fails(self, client):
+        client.return_value.invoke_shell.side_effect = paramiko.SSHException('no shell')
+        with self.assertRaises(paramiko.SSHException):
+            main.IndexHandler.ssh_connect(self.handler, self.args, paramiko.HostKeys())
+        client.return_value.close.assert_called_once_with()
+
+    def test_autoadd_writes_copy_only(self):
+        shared = self.handler.settings['host_keys']
+        shared.add('10.0.0.2', 'ssh-rsa', paramiko.RSAKey.generate(1024))
+        copied = main.copy_host_keys(shared)
+        known = len(copied._entries)
+
+        copied.add('10.0.0.1', 'ssh-rsa', paramiko.RSAKey.generate(1024))
+        self.assertEqual(list(shared.keys()), ['10.0.0.2'])
+
+        main.merge_host_keys(shared, copied._entries[known:])
+        self.assertEqual(sorted(shared.keys()), ['10.0.0.1', '10.0.0.2'])